@@ -16,6 +16,7 @@ import yaml
 import random
 import subprocess
 import urllib2
+import pipes
 from SPARQLWrapper import SPARQLWrapper, JSON
 from urllib2 import URLError
 
@@ -23,6 +24,13 @@ har_output_dir = os.environ['HAR_OUTPUT_DIR']
 container_data_dir = os.environ['CONTAINER_DATA_DIR']
 container_data_file = os.environ['CONTAINER_DATA_FILE']
 sleep_period = os.environ['SLEEP_PERIOD']
+# tcpdump-style capture filters handed to pcap2har, see pcap2har/capturefilter.py
+pcap_filter = os.environ.get('PCAP_FILTER', '')
+pcap_excludes = [e for e in os.environ.get('PCAP_EXCLUDE', '').split(';') if e.strip()]
+# body retention rules handed to pcap2har, see pcap2har/pcap2har/retention.py
+body_retention = [r for r in os.environ.get('BODY_RETENTION', '').split(';') if r.strip()]
+# directory of the content-addressed body store shared by all HARs, see pcap2har/pcap2har/blobstore.py
+blob_store_dir = os.environ.get('BLOB_STORE_DIR', '')
 sparqlQuery = SPARQLWrapper(os.environ.get('MU_SPARQL_ENDPOINT'), returnFormat=JSON)
 
 def query(query):
@@ -86,9 +94,41 @@ def transform_pcap(pcap_file, inputfolder, outputfolder):
     """
     output_name = os.path.join(outputfolder, pcap_file) + ".har"
     cmd = "python pcap2har {input} {output}".format(input=os.path.join(inputfolder, pcap_file), output=output_name)
+    cmd += filter_options()
+    cmd += retention_options()
+    cmd += blob_store_options()
     subprocess.Popen(cmd, shell=True).wait()
     return output_name
 
+def filter_options():
+    """
+    Builds the pcap2har command line options for the configured capture filters.
+    """
+    options = ""
+    if pcap_filter.strip():
+        options += " --filter " + pipes.quote(pcap_filter)
+    for exclude in pcap_excludes:
+        options += " --exclude " + pipes.quote(exclude)
+    return options
+
+def retention_options():
+    """
+    Builds the pcap2har command line options for the configured body retention rules.
+    """
+    options = ""
+    for rule in body_retention:
+        options += " --retain " + pipes.quote(rule.strip())
+    return options
+
+def blob_store_options():
+    """
+    Builds the pcap2har command line options for the body store. Bodies in the store
+    aren't in the HAR, so JSON bodies are parsed by pcap2har itself.
+    """
+    if not blob_store_dir.strip():
+        return ""
+    return " --blob-store " + pipes.quote(blob_store_dir) + " --parse-json"
+
 def network_monitors():
     results = query("""
        PREFIX logger:<http://mu.semte.ch/vocabularies/ext/docker-logger/>
@@ -120,8 +160,8 @@ def network_monitors():
 def enrich_har(monitor, har_file):
     """
     Modifies an existing HAR file with additional information about the container
-    it involves and the links to other containers. Also converts base64 strings
-    back into JSON format.
+    it involves and the links to other containers. Also parses JSON bodies
+    into JSON format.
     Information is repeated in each entry because each one will need to be posted
     sepparately into ElasticSearch.
 
@@ -150,9 +190,9 @@ def enrich_har(monitor, har_file):
     return newname
 
 
-def parse_recursive_har(meta, har, har_name, isBase64 = False, isEntry = False):
+def parse_recursive_har(meta, har, har_name, isEntry = False):
     """
-    Transform the har object decoding the base64 strings into JSON objects.
+    Transform the har object, parsing JSON bodies into JSON objects.
 
     Args:
         har: a single HAR (json) object.
@@ -164,10 +204,10 @@ def parse_recursive_har(meta, har, har_name, isBase64 = False, isEntry = False):
 
     # Loop through the keys in the HAR file
     for attr, value in har.iteritems():
-        # If we stumble upon base64 content, we call the function to decode it.
+        # If we stumble upon JSON content, we call the function to parse it.
         if (type(har[attr]) is dict) and (attr == "content"):
-            if "encoding" in har[attr].keys() and har[attr]["encoding"] == "base64" and (har[attr]["mimeType"] == "application/json" or har[attr]["mimeType"] == "application/vnd.api+json" or har[attr]["mimeType"] == "application/sparql-results+json"):
-                result[attr] = parse_recursive_har(meta, har[attr], har_name, True)
+            if is_json_type(har[attr].get("mimeType", "")):
+                result[attr] = parse_json_content(har[attr], har_name)
             else:
                 result[attr] = parse_recursive_har(meta, har[attr], har_name)
         # If the key is a dictionary just loop through it.
@@ -178,22 +218,62 @@ def parse_recursive_har(meta, har, har_name, isBase64 = False, isEntry = False):
             result[attr] = []
             if attr == "entries": # Enrich each entry in the entries[] array.
                 for i, val in enumerate(har[attr]):
-                    result[attr].append(parse_recursive_har(meta, val, har_name, False, True))
+                    result[attr].append(parse_recursive_har(meta, val, har_name, True))
             elif attr == "headers": # Convert headers from an array into an object.
-                result[attr] = { header['name']: header['value'] for header in har[attr] }
+                result[attr] = headers_to_object(har[attr])
             else:
                 for i, val in enumerate(har[attr]):
                     result[attr].append(parse_recursive_har(meta, val, har_name))
-        # If it is a value in base64 (previously detected) then decode it, otherwise return it as is.
+        # Anything else is returned as is.
         else:
-            if attr == "text" and isBase64 == True:
-                result[attr] = base64.b64decode(value)
-                try:
-                    result["json"] = json.loads( result[attr] )
-                except:
-                    logger.info( "Failed to parse JSON content of har " + har_name + " with content " + result[attr] );
-            else:
-                result[attr] = value
+            result[attr] = value
+    return result
+
+def headers_to_object(headers):
+    """
+    Converts a HAR headers array into an object. A header that appears more than once, like
+    Set-Cookie, gets a list of its values, in order.
+    """
+    result = {}
+    for header in headers:
+        name, value = header['name'], header['value']
+        if name not in result:
+            result[name] = value
+        elif type(result[name]) is list:
+            result[name].append(value)
+        else:
+            result[name] = [result[name], value]
+    return result
+
+def is_json_type(mime_type):
+    """
+    Whether a HAR mimeType is JSON, like application/json or application/vnd.api+json.
+    """
+    subtype = mime_type.partition('/')[2]
+    return subtype == "json" or subtype.endswith("+json")
+
+def parse_json_content(content, har_name):
+    """
+    Copies a HAR content object with a JSON body, adding the parsed body as "json".
+
+    pcap2har writes JSON bodies as text, and with --parse-json adds the parsed
+    body itself, as "_json" (the text may then be in the body store instead).
+    HARs from older versions have them base64 encoded.
+
+    Args:
+        content: the content object of a request or response.
+    """
+    result = dict(content)
+    parsed = result.pop("_json", None)
+    if parsed is None and "text" in result:
+        if result.get("encoding") == "base64":
+            result["text"] = base64.b64decode(result["text"])
+        try:
+            parsed = json.loads( result["text"] )
+        except:
+            logger.info( "Failed to parse JSON content of har " + har_name + " with content " + result["text"] );
+    if parsed is not None:
+        result["json"] = parsed
     return result
 
 def transformation_pipeline(monitor, inputfolder, outputfolder, processedfolder):
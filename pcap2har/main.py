@@ -16,6 +16,9 @@ from pcap2har import httpsession
 from pcap2har import har
 from pcap2har import tcp
 from pcap2har import settings
+from pcap2har import capturefilter
+from pcap2har import retention
+from pcap2har import blobstore
 from pcap2har.packetdispatcher import PacketDispatcher
 from pcap2har.pcaputil import print_rusage
 
@@ -27,7 +30,9 @@ parser = optparse.OptionParser(
 parser.add_option('--no-pages', action='store_false',
                   dest='pages', default=True)
 parser.add_option('-d', '--drop-bodies', action='store_true',
-                  dest='drop_bodies', default=False)
+                  dest='drop_bodies', default=False,
+                  help='leave message bodies out of the HAR. HTTP is then '
+                       'parsed headers-only, and bodies are never stored')
 parser.add_option('-k', '--keep-unfulfilled-requests', action='store_true',
                   dest='keep_unfulfilled', default=False)
 parser.add_option('-r', '--resource-usage', action='store_true',
@@ -36,6 +41,67 @@ parser.add_option('--pad_missing_tcp_data', action='store_true',
                   dest='pad_missing_tcp_data', default=False)
 parser.add_option('--strict-http-parsing', action='store_true',
                   dest='strict_http_parsing', default=False)
+parser.add_option('-f', '--filter', dest='capture_filter', default=None,
+                  metavar='EXPR',
+                  help='only process packets matching this tcpdump-style '
+                       'expression, eg. "tcp port 80 or net 10.0.0.0/8"')
+parser.add_option('-x', '--exclude', action='append', dest='capture_excludes',
+                  default=[], metavar='EXPR',
+                  help='drop packets matching this expression. May be given '
+                       'more than once. Adds to the default excludes')
+parser.add_option('--no-default-excludes', action='store_false',
+                  dest='default_excludes', default=True)
+parser.add_option('--follow', action='store_true', dest='follow',
+                  default=False,
+                  help='follow a pcap file that is still being written, and '
+                       'append HAR entries to outputfile, one JSON object '
+                       'per line, as soon as their connections close')
+parser.add_option('--follow-timeout', type='float', dest='follow_timeout',
+                  default=60.0, metavar='SECONDS',
+                  help='with --follow, stop once the input has not grown for '
+                       'this long')
+parser.add_option('--flow-timeout', type='float', dest='flow_timeout',
+                  default=None, metavar='SECONDS',
+                  help='consider connections done once they have been idle '
+                       'this long, in capture time. 0 to only close them on '
+                       'FIN/RST, which is the default, except with --follow '
+                       '(%g)' % settings.follow_flow_idle_timeout)
+parser.add_option('--http-port', type='int', action='append',
+                  dest='http_ports', default=[], metavar='PORT',
+                  help='treat connections on this port as HTTP, whatever '
+                       'their data looks like. May be given more than once')
+parser.add_option('--non-http-port', type='int', action='append',
+                  dest='non_http_ports', default=[], metavar='PORT',
+                  help='only count the packets of connections on this port, '
+                       'without reassembling them. May be given more than '
+                       'once')
+parser.add_option('--no-sniffing', action='store_false',
+                  dest='sniff_protocols', default=True,
+                  help='reassemble every connection, even if its data does '
+                       'not look like HTTP')
+parser.add_option('--max-body-size', type='int',
+                  dest='max_decompressed_body',
+                  default=settings.max_decompressed_body, metavar='BYTES',
+                  help='keep at most this many bytes of a decompressed body. '
+                       '0 for no limit')
+parser.add_option('--parse-json', action='store_true',
+                  dest='parse_json_bodies', default=False,
+                  help='also write the parsed value of JSON bodies into the '
+                       'HAR, as content._json')
+parser.add_option('--retain', action='append', dest='body_retention',
+                  default=[], metavar='RULE',
+                  help='body retention rule, like "mime=image/* drop" or '
+                       '"size>1m truncate=64" (see pcap2har/retention.py). '
+                       'The first matching rule decides. May be given more '
+                       'than once')
+parser.add_option('--blob-store', dest='blob_store', default=None,
+                  metavar='DIR',
+                  help='write bodies into a content-addressed store in DIR, '
+                       'once each, and only refer to them from the HAR')
+parser.add_option('--blob-min-size', type='int', dest='blob_min_size',
+                  default=settings.blob_min_size, metavar='BYTES',
+                  help='with --blob-store, keep bodies smaller than this in '
+                       'the HAR')
 parser.add_option('-l', '--log', dest='logfile', default='pcap2har.log')
 options, args = parser.parse_args()
 
@@ -45,6 +111,32 @@ settings.drop_bodies = options.drop_bodies
 settings.keep_unfulfilled_requests = options.keep_unfulfilled
 settings.pad_missing_tcp_data = options.pad_missing_tcp_data
 settings.strict_http_parse_body = options.strict_http_parsing
+if options.flow_timeout is not None:
+    settings.flow_idle_timeout = options.flow_timeout or None
+elif options.follow:
+    settings.flow_idle_timeout = settings.follow_flow_idle_timeout
+settings.capture_filter = options.capture_filter
+settings.sniff_protocols = options.sniff_protocols
+settings.http_ports = options.http_ports
+settings.non_http_ports = options.non_http_ports
+settings.max_decompressed_body = options.max_decompressed_body or None
+settings.parse_json_bodies = options.parse_json_bodies
+settings.body_retention = options.body_retention
+settings.blob_store = options.blob_store
+settings.blob_min_size = options.blob_min_size
+if not options.default_excludes:
+    settings.capture_excludes = []
+settings.capture_excludes = settings.capture_excludes + options.capture_excludes
+
+# check the filter before doing anything else
+try:
+    capturefilter.from_settings()
+except capturefilter.FilterError as e:
+    parser.error(str(e))
+try:
+    retention.from_settings()
+except retention.RetentionError as e:
+    parser.error(str(e))
 
 # setup logs
 logging.basicConfig(filename=options.logfile, level=logging.INFO)
@@ -61,20 +153,52 @@ else:
 
 logging.info('Processing %s', inputfile)
 
-# parse pcap file
-dispatcher = pcap.EasyParsePcap(filename=inputfile)
+if options.follow:
+    # pages span connections, so they can't be tracked entry by entry
+    settings.process_pages = False
+    dispatcher = PacketDispatcher()
+    session = httpsession.HttpSession(dispatcher)
+    with open(outputfile, 'a') as f:
+        def write_entries(flow):
+            session.add_flows([flow])
+            for entry in session.take_entries():
+                json.dump(entry, f, cls=har.JsonReprEncoder, encoding='utf8',
+                          sort_keys=True)
+                f.write('\n')
+            f.flush()
+        dispatcher.tcp.on_open = session.open_flow
+        dispatcher.tcp.on_close = write_entries
+        dispatcher.tcp.idle_timeout = settings.flow_idle_timeout
+        pcap.FollowPcap(dispatcher, inputfile, options.follow_timeout)
+    if blobstore.from_settings():
+        blobstore.from_settings().log_stats()
+    if options.resource_usage:
+        print_rusage()
+    sys.exit()
 
-# parse HAR stuff
+# parse pcap file, handing each TCP flow to the HTTP parser as it closes
+dispatcher = PacketDispatcher()
 session = httpsession.HttpSession(dispatcher)
+dispatcher.tcp.on_open = session.open_flow
+dispatcher.tcp.on_close = session.parse_flow
+pcap.ParsePcap(dispatcher, filename=inputfile)
+dispatcher.finish()
+
+# parse HAR stuff
+session.build_entries()
 
 
 logging.info('Flows=%d. HTTP pairs=%d' % (len(session.flows), len(session.entries)))
+logging.info('Non-HTTP flows=%d, packets=%d, bytes=%d' % (
+    session.other_flows, session.other_packets, session.other_bytes))
 
 #write the HAR file
 
 with open(outputfile, 'w') as f:
     json.dump(session, f, cls=har.JsonReprEncoder, indent=2, encoding='utf8', sort_keys=True)
     f.write('\n')
+if blobstore.from_settings():
+    blobstore.from_settings().log_stats()
 
 
 if options.resource_usage:
@@ -0,0 +1,179 @@
+'''
+Content-addressed store for HTTP bodies.
+
+With settings.blob_store set to a directory, har writes bodies of at least
+settings.blob_min_size bytes there, instead of into content.text, and
+content._blob holds the SHA-1 (in hex) of the stored bytes. The bytes are what
+content.text would have decoded to: the UTF-8 text for text bodies, the
+binary data itself for base64 ones. content.encoding is still set for the
+latter, so readers know which is which.
+
+Each body is stored once, gzipped, as DIGEST[:2]/DIGEST[2:].gz under the
+directory, so the same body in other entries, or in other HAR files written
+to the same store, is only a reference. Whether a body is there already is
+looked up in memory first, then on disk.
+'''
+
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+
+import settings
+
+
+class BlobStore(object):
+    '''
+    Members:
+    * directory = string, where the blobs go
+    * known = set of hex digests known to be in the store
+    * written = number of blobs written
+    * reused = number of bodies that were in the store already
+    '''
+
+    def __init__(self, directory):
+        '''
+        Args:
+        directory = string, created if it isn't there
+        '''
+        self.directory = directory
+        self.known = set()
+        self.written = 0
+        self.reused = 0
+
+    def path(self, digest):
+        '''
+        Returns the file name for a blob.
+        '''
+        return os.path.join(self.directory, digest[:2], digest[2:] + '.gz')
+
+    def put(self, data):
+        '''
+        Stores data, unless it's stored already. Returns its hex digest.
+        '''
+        digest = hashlib.sha1(data).hexdigest()
+        if digest in self.known:
+            self.reused += 1
+            return digest
+        path = self.path(digest)
+        if os.path.exists(path):
+            self.reused += 1
+        else:
+            self.write(path, data)
+            self.written += 1
+        self.known.add(digest)
+        return digest
+
+    def write(self, path, data):
+        '''
+        Writes a blob file. It's written under a temporary name and renamed
+        into place, so other processes sharing the store never see half of
+        it.
+        '''
+        subdirectory = os.path.dirname(path)
+        if not os.path.isdir(subdirectory):
+            try:
+                os.makedirs(subdirectory)
+            except OSError:
+                if not os.path.isdir(subdirectory):
+                    raise
+        fd, temp = tempfile.mkstemp(dir=subdirectory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                gzipfile = gzip.GzipFile(filename='', mode='wb', fileobj=f,
+                                         mtime=0)
+                gzipfile.write(data)
+                gzipfile.close()
+            os.rename(temp, path)
+        except:
+            os.unlink(temp)
+            raise
+
+    def get(self, digest):
+        '''
+        Returns the stored bytes for a hex digest. Raises IOError if they
+        aren't there.
+        '''
+        gzipfile = gzip.open(self.path(digest), 'rb')
+        try:
+            return gzipfile.read()
+        finally:
+            gzipfile.close()
+
+    def log_stats(self):
+        logging.info('Blob store %s: %d bodies written, %d already stored',
+                     self.directory, self.written, self.reused)
+
+
+# the store from_settings last opened
+store_cache = None
+
+
+def from_settings():
+    '''
+    Returns the BlobStore for settings.blob_store, or None if it isn't set.
+    The same store is returned for as long as the setting doesn't change.
+    '''
+    global store_cache
+    if not settings.blob_store:
+        return None
+    if store_cache is None or store_cache.directory != settings.blob_store:
+        store_cache = BlobStore(settings.blob_store)
+    return store_cache
+
+
+if __name__ == '__main__':
+    import shutil
+    import unittest
+
+    class BlobStoreTest(unittest.TestCase):
+        def setUp(self):
+            self.directory = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.directory)
+
+        def test_content_addressing(self):
+            store = BlobStore(self.directory)
+            digest = store.put('hello')
+            self.assertEqual(digest, hashlib.sha1('hello').hexdigest())
+            self.assertEqual(store.path(digest),
+                             os.path.join(self.directory, digest[:2],
+                                          digest[2:] + '.gz'))
+            assert os.path.exists(store.path(digest))
+            self.assertEqual(store.get(digest), 'hello')
+            self.assertNotEqual(store.put('world'), digest)
+            self.assertEqual((store.written, store.reused), (2, 0))
+
+        def test_stored_once(self):
+            store = BlobStore(self.directory)
+            digest = store.put('\x00binary\xff' * 100)
+            mtime = os.stat(store.path(digest)).st_mtime
+            self.assertEqual(store.put('\x00binary\xff' * 100), digest)
+            self.assertEqual((store.written, store.reused), (1, 1))
+            # another store on the same directory finds it on disk
+            other = BlobStore(self.directory)
+            self.assertEqual(other.put('\x00binary\xff' * 100), digest)
+            self.assertEqual((other.written, other.reused), (0, 1))
+            self.assertEqual(os.stat(store.path(digest)).st_mtime, mtime)
+            self.assertEqual(os.listdir(os.path.dirname(store.path(digest))),
+                             [digest[2:] + '.gz'])
+
+        def test_missing(self):
+            store = BlobStore(self.directory)
+            self.assertRaises(IOError, store.get, '0' * 40)
+
+        def test_from_settings(self):
+            saved = settings.blob_store
+            try:
+                settings.blob_store = None
+                assert from_settings() is None
+                settings.blob_store = self.directory
+                store = from_settings()
+                self.assertEqual(store.directory, self.directory)
+                assert from_settings() is store
+            finally:
+                settings.blob_store = saved
+
+    unittest.main()
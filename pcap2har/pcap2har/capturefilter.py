@@ -0,0 +1,377 @@
+'''
+Early capture filtering.
+
+Filters are written in a small subset of the tcpdump/BPF expression language
+and evaluated on the raw header fields pulled out by decoder.decode, before
+any packet objects are built or payloads copied. Supported primitives:
+
+    [src|dst] host ADDR-OR-NAME
+    [src|dst] net CIDR
+    [src|dst] port N
+    [src|dst] portrange N-M
+    tcp, udp, ip, ip6
+
+combined with and/&&, or/||, not/! and parentheses. As in tcpdump, a protocol
+may qualify the primitive that follows it, so 'tcp port 443' means
+'tcp and port 443'. Host names are resolved once, when the filter is
+compiled.
+
+The compiled filter is a function (proto, src, dst, sport, dport) -> bool,
+where the addresses are packed 4 or 16 byte strings.
+'''
+
+import re
+import socket
+
+import decoder
+import settings
+
+
+class FilterError(ValueError):
+    '''
+    Raised when a filter expression can't be parsed.
+    '''
+    pass
+
+
+# primitives that take an argument, and may follow src/dst
+ARG_PRIMITIVES = ('host', 'net', 'port', 'portrange')
+PROTOCOLS = {
+    'tcp': 'p == %d' % decoder.IP_PROTO_TCP,
+    'udp': 'p == %d' % decoder.IP_PROTO_UDP,
+    'ip': 'len(src) == 4',
+    'ip6': 'len(src) == 16',
+}
+OPERATORS = {'&&': 'and', '||': 'or', '!': 'not'}
+
+token_re = re.compile(r'\s*(\(|\)|&&|\|\||!|[^\s()!]+)')
+
+
+def tokenize(expression):
+    '''
+    Splits a filter expression into a list of tokens.
+    '''
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = token_re.match(expression, pos)
+        if not match:
+            raise FilterError('can\'t tokenize filter at "%s"' %
+                              expression[pos:])
+        token = match.group(1)
+        tokens.append(OPERATORS.get(token, token))
+        pos = match.end()
+    return tokens
+
+
+class Parser(object):
+    '''
+    Recursive-descent parser turning a token list into a python expression
+    over the names p, src, dst, sport and dport.
+    '''
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise FilterError('unexpected end of filter')
+        self.pos += 1
+        return token
+
+    def parse(self):
+        result = self.parse_or()
+        if self.peek() is not None:
+            raise FilterError('unexpected "%s" in filter' % self.peek())
+        return result
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek() == 'or':
+            self.next()
+            terms.append(self.parse_and())
+        return join('or', terms)
+
+    def parse_and(self):
+        factors = [self.parse_not()]
+        while self.peek() == 'and':
+            self.next()
+            factors.append(self.parse_not())
+        return join('and', factors)
+
+    def parse_not(self):
+        if self.peek() == 'not':
+            self.next()
+            return '(not %s)' % self.parse_not()
+        return self.parse_primary()
+
+    def parse_primary(self):
+        token = self.next()
+        if token == '(':
+            result = self.parse_or()
+            if self.next() != ')':
+                raise FilterError('unbalanced parentheses in filter')
+            return result
+        if token in PROTOCOLS:
+            # 'tcp port 80' is shorthand for 'tcp and port 80'
+            following = self.peek()
+            if following in ARG_PRIMITIVES or following in ('src', 'dst'):
+                return '(%s and %s)' % (PROTOCOLS[token],
+                                        self.parse_primary())
+            return '(%s)' % PROTOCOLS[token]
+        direction = None
+        if token in ('src', 'dst'):
+            direction = token
+            token = self.next()
+        if token not in ARG_PRIMITIVES:
+            raise FilterError('unknown filter primitive "%s"' % token)
+        arg = self.next()
+        return getattr(self, 'primitive_' + token)(direction, arg)
+
+    def primitive_host(self, direction, arg):
+        tests = []
+        for packed in resolve(arg):
+            tests.append(address_test(
+                direction, lambda name: '%s == %r' % (name, packed)))
+        return join('or', tests)
+
+    def primitive_net(self, direction, arg):
+        network, prefixlen = parse_cidr(arg)
+        return address_test(
+            direction, lambda name: prefix_test(name, network, prefixlen))
+
+    def primitive_port(self, direction, arg):
+        port = parse_port(arg)
+        return port_test(direction, '%%s == %d' % port)
+
+    def primitive_portrange(self, direction, arg):
+        try:
+            low, high = arg.split('-', 1)
+        except ValueError:
+            raise FilterError('invalid port range "%s"' % arg)
+        low, high = parse_port(low), parse_port(high)
+        return port_test(direction, '%d <= %%s <= %d' % (low, high))
+
+
+def join(op, parts):
+    if len(parts) == 1:
+        return parts[0]
+    return '(%s)' % (' %s ' % op).join(parts)
+
+
+def parse_port(s):
+    try:
+        port = int(s)
+    except ValueError:
+        raise FilterError('invalid port "%s"' % s)
+    if not 0 <= port <= 0xffff:
+        raise FilterError('port out of range: %d' % port)
+    return port
+
+
+def port_test(direction, template):
+    if direction == 'src':
+        return '(%s)' % (template % 'sport')
+    if direction == 'dst':
+        return '(%s)' % (template % 'dport')
+    return '(%s or %s)' % (template % 'sport', template % 'dport')
+
+
+def pack_address(s):
+    '''
+    Returns the packed form of an IPv4 or IPv6 address literal, or None.
+    '''
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, s)
+        except (socket.error, ValueError):
+            pass
+    return None
+
+
+def resolve(name):
+    '''
+    Returns the packed addresses for a host filter argument.
+    '''
+    packed = pack_address(name)
+    if packed is not None:
+        return [packed]
+    try:
+        infos = socket.getaddrinfo(name, None)
+    except socket.error:
+        raise FilterError('can\'t resolve host "%s"' % name)
+    addresses = []
+    for family, socktype, proto, canonname, sockaddr in infos:
+        packed = pack_address(sockaddr[0])
+        if packed is not None and packed not in addresses:
+            addresses.append(packed)
+    return addresses
+
+
+def prefix_test(name, network, prefixlen):
+    '''
+    Builds a test that the packed address in variable `name` lies in the
+    packed network with the given prefix length, using only string
+    comparisons.
+    '''
+    whole, bits = divmod(prefixlen, 8)
+    tests = ['len(%s) == %d' % (name, len(network))]
+    if whole:
+        tests.append('%s[:%d] == %r' % (name, whole, network[:whole]))
+    if bits:
+        mask = (0xff << (8 - bits)) & 0xff
+        tests.append('ord(%s[%d]) & %d == %d' % (
+            name, whole, mask, ord(network[whole]) & mask))
+    return '(%s)' % ' and '.join(tests)
+
+
+def parse_cidr(cidr):
+    '''
+    Returns (packed network, prefix length) for 'addr/len' or a bare address.
+    '''
+    if '/' in cidr:
+        net, prefixlen = cidr.split('/', 1)
+    else:
+        net, prefixlen = cidr, None
+    network = pack_address(net)
+    if network is None:
+        raise FilterError('invalid network "%s"' % cidr)
+    if prefixlen is None:
+        return network, len(network) * 8
+    try:
+        prefixlen = int(prefixlen)
+    except ValueError:
+        raise FilterError('invalid prefix length in "%s"' % cidr)
+    if not 0 <= prefixlen <= len(network) * 8:
+        raise FilterError('invalid prefix length in "%s"' % cidr)
+    return network, prefixlen
+
+
+def address_test(direction, make):
+    '''
+    Applies make(variable name) to src, dst or both, depending on direction.
+    '''
+    if direction == 'src':
+        return '(%s)' % make('src')
+    if direction == 'dst':
+        return '(%s)' % make('dst')
+    return '(%s or %s)' % (make('src'), make('dst'))
+
+
+def compile_expression(expression):
+    '''
+    Compiles a filter expression to python source for a boolean expression.
+    '''
+    tokens = tokenize(expression)
+    if not tokens:
+        raise FilterError('empty filter')
+    return Parser(tokens).parse()
+
+
+def compile_filter(include=None, excludes=()):
+    '''
+    Builds the packet filter function.
+
+    Args:
+    include = filter expression packets must match, or None for all packets
+    excludes = [filter expression], packets matching any of these are dropped
+
+    Returns:
+    function(proto, src, dst, sport, dport) -> bool, or None if everything
+    is accepted
+    '''
+    tests = []
+    if include:
+        tests.append(compile_expression(include))
+    for expression in excludes:
+        tests.append('(not %s)' % compile_expression(expression))
+    if not tests:
+        return None
+    source = 'lambda p, src, dst, sport, dport: %s' % ' and '.join(tests)
+    return eval(source, {'__builtins__': {'len': len, 'ord': ord}})
+
+
+def from_settings():
+    '''
+    Compiles the filter configured in the settings module.
+    '''
+    return compile_filter(settings.capture_filter, settings.capture_excludes)
+
+
+if __name__ == '__main__':
+    import unittest
+
+    TCP, UDP = decoder.IP_PROTO_TCP, decoder.IP_PROTO_UDP
+    A = socket.inet_pton(socket.AF_INET, '10.0.0.1')
+    B = socket.inet_pton(socket.AF_INET, '192.168.1.20')
+    C = socket.inet_pton(socket.AF_INET6, '2001:db8::1')
+
+    class CaptureFilterTest(unittest.TestCase):
+        def check(self, expression, packet, expected):
+            f = compile_filter(expression)
+            self.assertEqual(f(*packet), expected, (expression, packet))
+
+        def test_no_filter(self):
+            assert compile_filter() is None
+            assert compile_filter('', []) is None
+
+        def test_port(self):
+            packet = (TCP, A, B, 51000, 80)
+            self.check('port 80', packet, True)
+            self.check('src port 80', packet, False)
+            self.check('dst port 80', packet, True)
+            self.check('portrange 50000-52000', packet, True)
+            self.check('dst portrange 1-79', packet, False)
+
+        def test_protocols(self):
+            self.check('tcp port 80', (TCP, A, B, 1, 80), True)
+            self.check('tcp port 80', (UDP, A, B, 1, 80), False)
+            self.check('udp', (UDP, A, B, 1, 53), True)
+            self.check('ip', (TCP, A, B, 1, 80), True)
+            self.check('ip6', (TCP, A, B, 1, 80), False)
+            self.check('ip6', (TCP, C, C, 1, 80), True)
+
+        def test_host_and_net(self):
+            packet = (TCP, A, B, 1, 80)
+            self.check('host 10.0.0.1', packet, True)
+            self.check('dst host 10.0.0.1', packet, False)
+            self.check('net 192.168.0.0/16', packet, True)
+            self.check('src net 192.168.0.0/16', packet, False)
+            self.check('net 192.168.1.16/28', packet, True)
+            self.check('net 192.168.1.32/28', packet, False)
+            self.check('net 2001:db8::/32', packet, False)
+            self.check('net 2001:db8::/32', (TCP, C, C, 1, 80), True)
+
+        def test_operators(self):
+            packet = (TCP, A, B, 1, 80)
+            self.check('port 443 or port 80', packet, True)
+            self.check('port 443 || port 80', packet, True)
+            self.check('port 80 and not host 10.0.0.1', packet, False)
+            self.check('port 80 && !(port 443 or host 10.0.0.2)', packet,
+                       True)
+            self.check('not not port 80', packet, True)
+
+        def test_excludes(self):
+            f = compile_filter('tcp', ['port 443', 'host 10.0.0.1'])
+            assert f(TCP, B, B, 1, 80)
+            assert not f(TCP, B, B, 1, 443)
+            assert not f(TCP, A, B, 1, 80)
+            assert not f(UDP, B, B, 1, 80)
+
+        def test_errors(self):
+            for expression in ('port', 'port http', 'port 70000',
+                               'portrange 80', 'portrange 1-x', 'net 1.2.3/8',
+                               'net 10.0.0.0/33', 'net 10.0.0.0/x', 'src',
+                               'smtp', '(port 80', 'port 80)', 'port 80 or',
+                               'port 80 port 81', '   '):
+                self.assertRaises(FilterError, compile_filter, expression)
+
+    unittest.main()
@@ -0,0 +1,203 @@
+'''
+Fast link/network/transport header decoding.
+
+Pulls only the fields the rest of pcap2har uses straight out of the frame
+bytes at fixed offsets, instead of building a tree of dpkt objects for every
+packet. Frames that don't fit the common layouts (unknown link types, IPv6
+extension headers, MPLS, 802.3/LLC, truncated headers...) are handed to dpkt,
+so odd traffic is still decoded the same way it always was.
+
+decode() returns a tuple:
+
+    (proto, src, dst, sport, dport, seq, ack, flags, payload)
+
+proto is IP_PROTO_TCP or IP_PROTO_UDP, src and dst are packed addresses
+(4 or 16 byte strings), payload is a string. For UDP, seq, ack and flags are
+None. Frames that aren't TCP or UDP over IP decode to None.
+
+decode() optionally takes an accept function, as built by capturefilter. It is
+called with (proto, src, dst, sport, dport) as soon as those are known, and
+frames it rejects decode to None before their payload is copied.
+'''
+
+import struct
+
+import dpkt
+
+DLT_LINUX_SLL = dpkt.pcap.DLT_LINUX_SLL
+
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_IP6 = 0x86dd
+# 802.1Q, 802.1ad and the old pre-standard QinQ type
+ETH_TYPES_VLAN = (0x8100, 0x88a8, 0x9100)
+# ethertypes that dpkt knows how to look into and we don't
+ETH_TYPES_DPKT = (0x8847, 0x8848, 0x8863, 0x8864, 0x6558)
+
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+
+ETH_HDR_LEN = 14
+SLL_HDR_LEN = 16
+VLAN_TAG_LEN = 4
+IP6_HDR_LEN = 40
+TCP_HDR_LEN = 20
+UDP_HDR_LEN = 8
+
+unpack_from = struct.unpack_from
+ip4_hdr = struct.Struct('>BxH2xHxB2x4s4s')  # v_hl, len, off, p, src, dst
+ip6_hdr = struct.Struct('>4xHBx16s16s')  # plen, nxt, src, dst
+tcp_hdr = struct.Struct('>HHIIH')  # sport, dport, seq, ack, off_flags
+udp_hdr = struct.Struct('>HH')  # sport, dport
+
+
+class Fallback(Exception):
+    '''
+    Raised internally when a frame has to be decoded by dpkt.
+    '''
+    pass
+
+
+def decode(buf, linktype, accept=None):
+    '''
+    Decodes a frame from a pcap file.
+
+    Args:
+    buf = string or buffer, the frame data
+    linktype = int, DLT_* link type of the capture
+    accept = function(proto, src, dst, sport, dport) -> bool, or None
+
+    Returns:
+    see module docstring. Raises dpkt.Error if dpkt fails on the frame.
+    '''
+    try:
+        if linktype == DLT_LINUX_SLL:
+            if len(buf) < SLL_HDR_LEN:
+                raise Fallback
+            ethtype, = unpack_from('>H', buf, 14)
+            offset = SLL_HDR_LEN
+        else:
+            if len(buf) < ETH_HDR_LEN:
+                raise Fallback
+            ethtype, = unpack_from('>H', buf, 12)
+            offset = ETH_HDR_LEN
+            # dpkt handles up to two tags; so do we
+            for i in range(2):
+                if ethtype not in ETH_TYPES_VLAN:
+                    break
+                if len(buf) < offset + VLAN_TAG_LEN:
+                    raise Fallback
+                ethtype, = unpack_from('>H', buf, offset + 2)
+                offset += VLAN_TAG_LEN
+        if ethtype == ETH_TYPE_IP:
+            return decode_ip(buf, offset, accept)
+        elif ethtype == ETH_TYPE_IP6:
+            return decode_ip6(buf, offset, accept)
+        elif ethtype <= 1500 or ethtype in ETH_TYPES_DPKT:
+            raise Fallback
+        elif linktype != DLT_LINUX_SLL and ethtype in ETH_TYPES_VLAN:
+            raise Fallback  # more tags than we bother with
+        return None
+    except Fallback:
+        return decode_dpkt(buf, linktype, accept)
+
+
+def decode_ip(buf, offset, accept):
+    '''
+    Decodes an IPv4 packet starting at offset in buf.
+    '''
+    if len(buf) < offset + 20:
+        raise Fallback
+    v_hl, length, off, p, src, dst = ip4_hdr.unpack_from(buf, offset)
+    hl = (v_hl & 0xf) << 2
+    if v_hl >> 4 != 4 or hl < 20:
+        raise Fallback
+    if off & dpkt.ip.IP_OFFMASK:
+        # not the first fragment; dpkt doesn't look inside these either
+        return None
+    start = offset + hl
+    # like dpkt, trust the length field unless it's 0 (segmentation offload)
+    if length:
+        end = min(offset + length, len(buf))
+    else:
+        end = len(buf)
+    return decode_transport(buf, start, end, p, src, dst, accept)
+
+
+def decode_ip6(buf, offset, accept):
+    '''
+    Decodes an IPv6 packet starting at offset in buf. Extension headers are
+    left to dpkt.
+    '''
+    if len(buf) < offset + IP6_HDR_LEN:
+        raise Fallback
+    plen, nxt, src, dst = ip6_hdr.unpack_from(buf, offset)
+    if nxt != IP_PROTO_TCP and nxt != IP_PROTO_UDP:
+        raise Fallback
+    start = offset + IP6_HDR_LEN
+    if plen:
+        end = min(start + plen, len(buf))
+    else:
+        end = len(buf)
+    return decode_transport(buf, start, end, nxt, src, dst, accept)
+
+
+def decode_transport(buf, start, end, p, src, dst, accept):
+    '''
+    Decodes the TCP or UDP header in buf[start:end].
+    '''
+    if p == IP_PROTO_TCP:
+        if end - start < TCP_HDR_LEN:
+            raise Fallback
+        sport, dport, seq, ack, off_flags = tcp_hdr.unpack_from(buf, start)
+        hl = (off_flags >> 12) << 2
+        if hl < TCP_HDR_LEN:
+            raise Fallback
+        if accept and not accept(p, src, dst, sport, dport):
+            return None
+        return (IP_PROTO_TCP, src, dst, sport, dport, seq, ack,
+                off_flags & 0x1ff, buf[start + hl:end])
+    elif p == IP_PROTO_UDP:
+        if end - start < UDP_HDR_LEN:
+            raise Fallback
+        sport, dport = udp_hdr.unpack_from(buf, start)
+        if accept and not accept(p, src, dst, sport, dport):
+            return None
+        return (IP_PROTO_UDP, src, dst, sport, dport, None, None, None,
+                buf[start + UDP_HDR_LEN:end])
+    return None
+
+
+def decode_dpkt(buf, linktype, accept=None):
+    '''
+    Decodes the frame the slow way, with dpkt. Same arguments and return
+    value as decode().
+    '''
+    # handle SLL packets, thanks Libo
+    if linktype == DLT_LINUX_SLL:
+        eth = dpkt.sll.SLL(buf)
+    # otherwise, for now, assume Ethernet
+    else:
+        eth = dpkt.ethernet.Ethernet(buf)
+    fields = fields_from_dpkt(eth)
+    if fields and accept and not accept(*fields[:5]):
+        return None
+    return fields
+
+
+def fields_from_dpkt(eth):
+    '''
+    Extracts the decode() fields from a dpkt.ethernet.Ethernet or
+    dpkt.sll.SLL.
+    '''
+    if (isinstance(eth.data, dpkt.ip.IP) or
+        isinstance(eth.data, dpkt.ip6.IP6)):
+        ip = eth.data
+        if isinstance(ip.data, dpkt.tcp.TCP):
+            tcp = ip.data
+            return (IP_PROTO_TCP, ip.src, ip.dst, tcp.sport, tcp.dport,
+                    tcp.seq, tcp.ack, tcp.flags, tcp.data)
+        elif isinstance(ip.data, dpkt.udp.UDP):
+            udp = ip.data
+            return (IP_PROTO_UDP, ip.src, ip.dst, udp.sport, udp.dport,
+                    None, None, None, udp.data)
+    return None
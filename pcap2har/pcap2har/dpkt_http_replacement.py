@@ -10,122 +10,341 @@ import dpkt
 import logging
 import settings
 
+# headers whose values repeat from message to message. their values are
+# interned, like all header names, so messages share one copy of each.
+INTERNED_VALUES = frozenset([
+    'accept', 'accept-encoding', 'accept-language', 'accept-ranges',
+    'cache-control', 'connection', 'content-encoding', 'content-type',
+    'host', 'pragma', 'server', 'transfer-encoding', 'user-agent', 'vary',
+    'via', 'x-powered-by',
+])
+
+
+def add_header(d, line):
+    """
+    Add the header on one line to the dict d. A header that is already there
+    becomes a list of values, in order. Returns False if the line is blank,
+    that is, it ends the headers.
+    """
+    # regular dpkt checks for premature end of headers
+    # but that's too picky
+    line = line.strip()
+    if not line:
+        return False
+    l = line.split(None, 1)
+    if not l[0].endswith(':'):
+        raise dpkt.UnpackError('invalid header: %r' % line)
+    k = intern(l[0][:-1].lower())
+    v = len(l) != 1 and l[1] or ''
+    if k in INTERNED_VALUES:
+        v = intern(v)
+    if k in d:
+        if type(d[k]) is list:
+            d[k].append(v)
+        else:
+            d[k] = [d[k], v]
+    else:
+        d[k] = v
+    return True
+
+
 def parse_headers(f):
     """Return dict of HTTP headers parsed from a file object."""
     d = {}
-    while 1:
-        line = f.readline()
-        # regular dpkt checks for premature end of headers
-        # but that's too picky
-        line = line.strip()
-        if not line:
+    while add_header(d, f.readline()):
+        pass
+    return d
+
+
+def parse_header_lines(lines):
+    """Return dict of HTTP headers parsed from a list of lines."""
+    d = {}
+    for line in lines:
+        if not add_header(d, line):
             break
-        l = line.split(None, 1)
-        if not l[0].endswith(':'):
-            raise dpkt.UnpackError('invalid header: %r' % line)
-        k = l[0][:-1].lower()
-        v = len(l) != 1 and l[1] or ''
-        if k in d:
-            d[k] += ','+v
-        else:
-            d[k] = v
     return d
 
 
-def parse_length(s, base=10):
-    """Take a string and convert to int (not long), returning 0 if invalid"""
+def parse_header_block(buf, offset=0):
+    """
+    Parse the headers starting at buf[offset], up to the first blank line.
+
+    Rather than reading line by line, finds the end of the block first and
+    splits it up in one go. Returns (headers, end), where end is the offset in
+    buf just past the blank line, or len(buf) if the headers run to the end.
+    """
+    # no headers at all
+    if buf.startswith('\r\n', offset):
+        return {}, offset + 2
+    if buf.startswith('\n', offset):
+        return {}, offset + 1
+    end = buf.find('\n\r\n', offset)
+    if end < 0:
+        bare = buf.find('\n\n', offset)
+    else:
+        bare = buf.find('\n\n', offset, end + 1)
+    if bare >= 0:
+        end, sep = bare, 2
+    else:
+        sep = 3
+    if end < 0:
+        block = buf[offset:]
+        end, sep = len(buf), 0
+    else:
+        block = buf[offset:end]
+    d = {}
+    pos = offset
+    for line in block.split('\n'):
+        if not add_header(d, line):
+            # a line of nothing but whitespace ends the headers, too. so
+            # does the end of buf.
+            return d, min(pos + len(line) + 1, len(buf))
+        pos += len(line) + 1
+    return d, end + sep
+
+
+def header_value(headers, name, default=None):
+    """
+    Return the value of a header as one string. Repeated headers, which the
+    parsers keep as lists, are joined with commas, as HTTP says they may be.
+    """
+    v = headers.get(name, default)
+    if type(v) is list:
+        return ','.join(v)
+    return v
+
+
+def parse_length(s, base=10, warn=True):
+    """
+    Take a string and convert to int (not long), returning 0 if invalid.
+    Negative lengths are invalid too.
+    """
     try:
         n = int(s, base)
         # int() can actually return long, which can't be used in file.read()
-        if isinstance(n, int):
+        if isinstance(n, int) and n >= 0:
             return n
     except ValueError:
         pass
-    # if s was invalid or too big (that is, int returned long)...
-    logging.warn('Invalid HTTP content/chunk length "%s", assuming 0' % s)
+    # if s was invalid, negative or too big (that is, int returned long)...
+    if warn:
+        logging.warn('Invalid HTTP content/chunk length "%s", assuming 0' % s)
     return 0
 
 
-def parse_body(f, version, headers):
-    """Return HTTP body parsed from a file object, given HTTP header dict."""
-    if headers.get('transfer-encoding', '').lower() == 'chunked':
-        l = []
-        found_end = False
-        while 1:
-            try:
-                sz = f.readline().split(None, 1)[0]
-            except IndexError:
-                raise dpkt.UnpackError('missing chunk size')
-            n = parse_length(sz, 16)
-            if n == 0:  # may happen if sz is invalid
-                found_end = True
-            buf = f.read(n)
-            if f.readline().strip():
-                break
-            if n and len(buf) == n:
-                l.append(buf)
-            else:
-                break
-        if settings.strict_http_parse_body and not found_end:
-            raise dpkt.NeedData('premature end of chunked body')
-        body = ''.join(l)
+# how a message body is delimited, see body_framing
+BODY_NONE = 'none'
+BODY_CHUNKED = 'chunked'
+BODY_LENGTH = 'length'
+BODY_UNTIL_CLOSE = 'close'
+
+
+def body_framing(message, warn=True):
+    """
+    Decide how the body of a message is delimited, from its start line and
+    headers.
+
+    Returns (framing, length): one of (BODY_NONE, 0), (BODY_CHUNKED, None),
+    (BODY_LENGTH, n) or (BODY_UNTIL_CLOSE, None).
+    """
+    # these never have a body, whatever the headers say
+    if getattr(message, 'status', None) in ('204', '304'):
+        return BODY_NONE, 0
+    headers = message.headers
+    if header_value(headers, 'transfer-encoding', '').lower() == 'chunked':
+        return BODY_CHUNKED, None
     elif 'content-length' in headers:
         # Ethan K B: Have observed malformed 0,0 content lengths
-        n = parse_length(headers['content-length'])
+        return BODY_LENGTH, parse_length(
+            header_value(headers, 'content-length'), warn=warn)
+    # XXX - need to handle HTTP/0.9
+    elif message.version == '1.0':
+        # we can assume that there are no further
+        # responses on this stream, since 1.0 doesn't
+        # support keepalive
+        return BODY_UNTIL_CLOSE, None
+    elif (message.version == '1.1' and
+          header_value(headers, 'connection') == 'close'):
+        # sender has said they won't send anything else.
+        return BODY_UNTIL_CLOSE, None
+    # there's also the case where other end sends connection: close,
+    # but we don't have the architecture to handle that.
+    else:
+        # we don't really know what to do
+        return BODY_NONE, 0
+
+
+def parse_chunk_size(line, warn=True):
+    """
+    Return the size from a chunk size line, ignoring any chunk extension.
+    Invalid sizes come out as 0, which ends the body. Raises
+    dpkt.UnpackError if there's no size at all.
+    """
+    l = line.split(None, 1)
+    if not l:
+        raise dpkt.UnpackError('missing chunk size')
+    return parse_length(l[0].split(';', 1)[0], 16, warn)
+
+
+def add_trailer(headers, line, warn=True):
+    """
+    Add a trailer line after a chunked body to headers. Trailers are just
+    more headers. Returns False if the line is blank, which ends the message,
+    and None if it isn't a header at all: then the message ended just before
+    it, and the line belongs to whatever comes next.
+    """
+    try:
+        return add_header(headers, line)
+    except dpkt.UnpackError:
+        if warn:
+            logging.warn('Invalid HTTP trailer, ending the message before '
+                         'it: %r' % line)
+        return None
+
+
+def parse_chunked(buf, offset, headers):
+    """
+    Decode the chunked body starting at buf[offset].
+
+    Works on offsets into buf, instead of reading through a file object:
+    each chunk is sliced out once, and a body in a single chunk is just that
+    slice, not joined. Trailers after the last chunk are added to headers,
+    up to an empty line, or up to the first line that isn't a header, which
+    is left where it is.
+
+    A chunk that isn't followed by an empty line is dropped, and ends the
+    body. If buf ends before the last chunk, what came before is the body;
+    how much is missing is logged (and with strict_http_parse_body,
+    dpkt.NeedData is raised).
+
+    Returns (body, end), where end is the offset in buf just past the body.
+    """
+    chunks = []
+    pos = offset
+    size = len(buf)
+    missing = None  # bytes we know are missing, if the body is cut short
+    find = buf.find
+    while 1:
+        if pos >= size:
+            missing = 0  # cut off between chunks
+            break
+        eol = find('\n', pos)
+        if eol < 0:
+            eol = size - 1
+        line = buf[pos:eol + 1]
+        pos = eol + 1
+        # int() copes with the usual size line, surrounding whitespace and
+        # all. extensions and bad sizes need parse_chunk_size.
+        try:
+            n = int(line, 16)
+        except ValueError:
+            n = parse_chunk_size(line)
+        else:
+            if n < 0 or type(n) is not int:
+                n = parse_chunk_size(line)
+        if n == 0:
+            # the last chunk. trailers run up to an empty line.
+            while pos < size:
+                eol = find('\n', pos)
+                if eol < 0:
+                    eol = size - 1
+                line = buf[pos:eol + 1]
+                added = add_trailer(headers, line)
+                if added is None:
+                    break
+                pos = eol + 1
+                if not added:
+                    break
+            break
+        data_end = pos + n
+        if data_end > size:
+            missing = data_end - size  # the chunk itself is cut short
+            pos = size
+            break
+        # the data should be followed by an empty line
+        if buf.startswith('\r\n', data_end):
+            chunks.append(buf[pos:data_end])
+            pos = data_end + 2
+            continue
+        eol = find('\n', data_end)
+        if eol < 0:
+            eol = size - 1
+        line = buf[data_end:eol + 1]
+        pos = eol + 1
+        if line.strip():
+            break  # not a chunk after all
+        chunks.append(buf[data_end - n:data_end])
+    if missing is not None:
+        logging.warn('premature end of chunked body (missing %d bytes of '
+                     'the last chunk, and any chunks after it)', missing)
+        if settings.strict_http_parse_body:
+            raise dpkt.NeedData('premature end of chunked body')
+    if len(chunks) == 1:
+        return chunks[0], pos
+    return ''.join(chunks), pos
+
+
+def parse_body(f, framing, n):
+    """
+    Return HTTP body parsed from a file object, given its body_framing.
+    Chunked bodies are done by parse_chunked instead.
+    """
+    if framing == BODY_LENGTH:
         body = f.read(n)
         if len(body) != n:
             logging.warn('HTTP content-length mismatch: expected %d, got %d', n,
                          len(body))
             if settings.strict_http_parse_body:
                 raise dpkt.NeedData('short body (missing %d bytes)' % (n - len(body)))
+    elif framing == BODY_UNTIL_CLOSE:
+        body = f.read()
     else:
-        # XXX - need to handle HTTP/0.9
-        # BTW, this function is not called if status code is 204 or 304
-        if version == '1.0':
-            # we can assume that there are no further
-            # responses on this stream, since 1.0 doesn't
-            # support keepalive
-            body = f.read()
-        elif (version == '1.1' and
-              headers.get('connection', None) == 'close'):
-            # sender has said they won't send anything else.
-            body = f.read()
-        # there's also the case where other end sends connection: close,
-        # but we don't have the architecture to handle that.
-        else:
-            # we don't really know what to do
-            #print 'returning body as empty string:', version, headers
-            body = ''
+        body = ''
     return body
 
-def parse_message(message, f):
+def parse_message(message, buf, f):
     """
     Unpack headers and optionally body from the passed file-like object.
 
     Args:
       message: Request or Response to which to add data.
-      f: file-like object, probably StringIO.
+      buf: string, the data f reads from.
+      f: cStringIO.StringIO over buf, positioned at the headers.
+
+    Sets message.end to the position in f just past the message. Whatever
+    follows is left where it is, rather than copied out into message.data.
     """
-    # Parse headers
-    message.headers = parse_headers(f)
+    # Parse headers, straight out of buf
+    message.headers, end = parse_header_block(buf, f.tell())
+    f.seek(end)
     # Parse body, unless we know there isn't one
-    if not (getattr(message, 'status', None) in ('204', '304')):
-        message.body = parse_body(f, message.version, message.headers)
+    framing, n = body_framing(message)
+    if framing == BODY_CHUNKED:
+        message.body, end = parse_chunked(buf, end, message.headers)
+        f.seek(end)
     else:
-        message.body = ''
-    # Save the rest
-    message.data = f.read()
+        message.body = parse_body(f, framing, n)
+    message.body_length = len(message.body)
+    # Remember where the message ended
+    message.end = f.tell()
 
 class Message(dpkt.Packet):
-    """Hypertext Transfer Protocol headers + body."""
+    """Hypertext Transfer Protocol headers + body.
+
+    Message(buf, offset) parses the message starting at buf[offset]; end is
+    then the offset in buf just past it. buf is read in place, not copied.
+
+    body_length is the length of the body, even if body has been dropped."""
     __metaclass__ = type
     __hdr_defaults__ = {}
     headers = None
     body = None
+    body_length = 0
+    end = None
 
     def __init__(self, *args, **kwargs):
         if args:
-            self.unpack(args[0])
+            self.unpack(*args)
         else:
             self.headers = {}
             self.body = ''
@@ -134,12 +353,19 @@ class Message(dpkt.Packet):
             for k, v in kwargs.iteritems():
                 setattr(self, k, v)
 
-    def unpack(self, buf):
+    def unpack(self, buf, offset=0):
         f = cStringIO.StringIO(buf)
-        parse_message(self, f)
+        f.seek(offset)
+        parse_message(self, buf, f)
 
     def pack_hdr(self):
-        return ''.join([ '%s: %s\r\n' % t for t in self.headers.iteritems() ])
+        l = []
+        for k, v in self.headers.iteritems():
+            if type(v) is list:
+                l.extend([ '%s: %s\r\n' % (k, x) for x in v ])
+            else:
+                l.append('%s: %s\r\n' % (k, v))
+        return ''.join(l)
 
     def __len__(self):
         return len(str(self))
@@ -154,7 +380,7 @@ class Request(Message):
         'uri':'/',
         'version':'1.0',
         }
-    __methods = dict.fromkeys((
+    methods = dict.fromkeys((
         'GET', 'PUT', 'ICY', 'PATCH',
         'COPY', 'HEAD', 'LOCK', 'MOVE', 'POLL', 'POST',
         'BCOPY', 'BMOVE', 'MKCOL', 'TRACE', 'LABEL', 'MERGE',
@@ -167,11 +393,16 @@ class Request(Message):
         'VERSION-CONTROL',
         'BASELINE-CONTROL'
         ))
+    __methods = methods
     __proto = 'HTTP'
 
-    def unpack(self, buf):
+    def unpack(self, buf, offset=0):
         f = cStringIO.StringIO(buf)
-        line = f.readline()
+        f.seek(offset)
+        self.unpack_start_line(f.readline())
+        parse_message(self, buf, f)
+
+    def unpack_start_line(self, line):
         l = line.strip().split()
         if len(l) != 3 or l[0] not in self.__methods or \
            not l[2].startswith(self.__proto):
@@ -179,7 +410,6 @@ class Request(Message):
         self.method = l[0]
         self.uri = l[1]
         self.version = l[2][len(self.__proto)+1:]
-        parse_message(self, f)
 
     def __str__(self):
         return '%s %s %s/%s\r\n' % (self.method, self.uri, self.__proto,
@@ -194,16 +424,19 @@ class Response(Message):
         }
     __proto = 'HTTP'
 
-    def unpack(self, buf):
+    def unpack(self, buf, offset=0):
         f = cStringIO.StringIO(buf)
-        line = f.readline()
+        f.seek(offset)
+        self.unpack_start_line(f.readline())
+        parse_message(self, buf, f)
+
+    def unpack_start_line(self, line):
         l = line.strip().split(None, 2)
         if len(l) < 3 or not l[0].startswith(self.__proto) or not l[1].isdigit():
             raise dpkt.UnpackError('invalid response: %r' % line)
         self.version = l[0][len(self.__proto)+1:]
         self.status = l[1]
         self.reason = l[2]
-        parse_message(self, f)
 
     def __str__(self):
         return '%s/%s %s %s\r\n' % (self.__proto, self.version, self.status,
@@ -251,4 +484,51 @@ if __name__ == '__main__':
             assert type(r.headers['set-cookie']) is list
             assert len(r.headers['set-cookie']) == 2
 
+    class ChunkedTest(unittest.TestCase):
+        def test_extensions(self):
+            s = '3;name=value\r\nabc\r\n2 ; x\r\nde\r\n0;last\r\n\r\nNEXT'
+            headers = {}
+            body, end = parse_chunked(s, 0, headers)
+            assert body == 'abcde'
+            assert s[end:] == 'NEXT'
+            assert headers == {}
+
+        def test_trailers(self):
+            s = '3\r\nabc\r\n0\r\nX-A: 1\r\nX-B: 2\r\nX-A: 3\r\n\r\nNEXT'
+            headers = {}
+            body, end = parse_chunked(s, 0, headers)
+            assert body == 'abc'
+            assert s[end:] == 'NEXT'
+            assert headers == {'x-a': ['1', '3'], 'x-b': '2'}
+
+        def test_invalid_trailer_ends_message(self):
+            s = '3\r\nabc\r\n0\r\nX-A: 1\r\nHTTP/1.1 200 OK\r\nX-B: 2\r\n\r\n'
+            headers = {}
+            body, end = parse_chunked(s, 0, headers)
+            assert body == 'abc'
+            assert s[end:] == 'HTTP/1.1 200 OK\r\nX-B: 2\r\n\r\n'
+            assert headers == {'x-a': '1'}
+
+        def test_pipelined_after_chunked(self):
+            second = 'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nhi'
+            s = ('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                 '2\r\nab\r\n0\r\n' + second)
+            r = Response(s)
+            assert r.body == 'ab'
+            assert s[r.end:] == second
+            assert Response(s, r.end).body == 'hi'
+
+        def test_premature_end(self):
+            for s, body in [('3\r\nabc\r\n', 'abc'),
+                            ('3\r\nabc\r\n5\r\nde', 'abc'),
+                            ('3\r\nabc\r\n0\r\nX-A: 1\r\n', 'abc')]:
+                assert parse_chunked(s, 0, {}) == (body, len(s))
+            strict = settings.strict_http_parse_body
+            settings.strict_http_parse_body = True
+            try:
+                self.assertRaises(dpkt.NeedData, parse_chunked,
+                                  '3\r\nabc\r\n5\r\nde', 0, {})
+            finally:
+                settings.strict_http_parse_body = strict
+
     unittest.main()
@@ -2,18 +2,29 @@
 functions and classes for generating HAR data from parsed http data
 '''
 
+import hashlib
 import http
 import json
 
+import blobstore
+import dpkt_http_replacement as dpkt_http
+import retention
+import settings
 
-# json_repr for HTTP header dicts
+
+# json_repr for HTTP header dicts. repeated headers are lists of values, and
+# get an entry each.
 def header_json_repr(d):
-    return [
-        {
-            'name': k,
-            'value': v
-        } for k, v in sorted(d.iteritems())
-    ]
+    output = []
+    for k, v in sorted(d.iteritems()):
+        if type(v) is not list:
+            v = [v]
+        for value in v:
+            output.append({
+                'name': k,
+                'value': value
+            })
+    return output
 
 
 def query_json_repr(d):
@@ -29,23 +40,82 @@ def query_json_repr(d):
     return output
 
 
-# add json_repr methods to http classes
-def HTTPRequestJsonRepr(self):
+def content_json_repr(self):
     '''
-    self = http.Request
+    self = http.Request or http.Response
+
+    Returns the HAR content object, with as much of the body as the retention
+    policy keeps.
     '''
+    action, limit = retention.from_settings().choose(self)
+    self.decode(text=action in (retention.KEEP, retention.TRUNCATE),
+                limit=limit)
+    if action == retention.DROP:
+        return {
+            'size': self.body_length,
+            'mimeType': self.mimeType
+        }
     content = {
         'size': self.body_length,
         'mimeType': self.mimeType
     }
     if self.compression_amount is not None:
         content['compression'] = self.compression_amount
+    comments = []
+    if self.body_incomplete:
+        comments.append('body incomplete, its compressed data is cut short '
+                        'or corrupt')
+    if self.text_truncated:
+        comments.append('text truncated to %d bytes' % limit)
+    elif self.body_truncated:
+        comments.append('text truncated to %d bytes' % len(self.body))
+    if comments:
+        content['comment'] = '; '.join(comments)
+    if action == retention.HASH and self.body:
+        content['_sha1'] = hashlib.sha1(self.body).hexdigest()
     if self.text:
         if self.encoding:
-            content['text'] = self.text
+            text = self.text
             content['encoding'] = self.encoding
         else:
-            content['text'] = self.text.encode('utf8')  # must transcode to utf-8
+            text = self.text.encode('utf8')  # must transcode to utf-8
+        blob = store_blob(self, text, limit)
+        if blob:
+            content['_blob'] = blob
+        else:
+            content['text'] = text
+    if self.json is not None:
+        content['_json'] = self.json
+    return content
+
+
+def store_blob(self, text, limit):
+    '''
+    self = http.Request or http.Response
+
+    Puts the body into the blob store (see blobstore.py), if there is one and
+    the body is big enough. Returns its digest, or None if it goes into
+    content.text after all.
+    '''
+    store = blobstore.from_settings()
+    if store is None:
+        return None
+    if self.encoding:
+        # store the binary data, not its base64
+        data = self.body[:limit] if self.text_truncated else self.body
+    else:
+        data = text
+    if len(data) < settings.blob_min_size:
+        return None
+    return store.put(data)
+
+
+# add json_repr methods to http classes
+def HTTPRequestJsonRepr(self):
+    '''
+    self = http.Request
+    '''
+    content = content_json_repr(self)
     return {
         'method': self.msg.method,
         'url': self.url,
@@ -54,25 +124,14 @@ def HTTPRequestJsonRepr(self):
         'queryString': query_json_repr(self.query),
         'headersSize': -1,
         'headers': header_json_repr(self.msg.headers),
-        'bodySize': len(self.msg.body),
+        'bodySize': self.msg.body_length,
         'content': content
     }
 http.Request.json_repr = HTTPRequestJsonRepr
 
 
 def HTTPResponseJsonRepr(self):
-    content = {
-        'size': self.body_length,
-        'mimeType': self.mimeType
-    }
-    if self.compression_amount is not None:
-        content['compression'] = self.compression_amount
-    if self.text:
-        if self.encoding:
-            content['text'] = self.text
-            content['encoding'] = self.encoding
-        else:
-            content['text'] = self.text.encode('utf8')  # must transcode to utf-8
+    content = content_json_repr(self)
     return {
         'status': int(self.msg.status),
         'statusText': self.msg.reason,
@@ -80,7 +139,7 @@ def HTTPResponseJsonRepr(self):
         'cookies': [],
         'headersSize': -1,
         'bodySize': self.raw_body_length,
-        'redirectURL': self.msg.headers['location'] if 'location' in self.msg.headers else '',
+        'redirectURL': dpkt_http.header_value(self.msg.headers, 'location', ''),
         'headers': header_json_repr(self.msg.headers),
         'content': content,
     }
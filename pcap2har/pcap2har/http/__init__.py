@@ -1,5 +1,6 @@
 from message import Message
 from request import Request
 from response import Response
-from flow import Flow
+from flow import Flow, sniff
+from stream import StreamParser
 from common import Error
@@ -0,0 +1,185 @@
+'''
+Works out the character encoding of text bodies, for http.Response.
+
+UnicodeDammit makes sense of nearly anything, but it's slow, and may run
+chardet over the whole body, while nearly all bodies are ASCII or UTF-8, or
+in the charset their content-type declares. So decoding goes in tiers:
+
+1. the declared charset, strictly
+2. UTF-8 (which takes care of ASCII too), strictly
+3. whatever UnicodeDammit (or, without it, a simple guess) makes of it
+
+The first two tiers come out just as UnicodeDammit would, which tries them
+in the same order. They're skipped for bodies UnicodeDammit treats specially
+(byte order marks, XML declarations, UTF-16 and the like), or that declare
+a charset python doesn't know by that name, or in which UnicodeDammit would
+convert MS smart quotes.
+
+What the last tier detects for other bodies is remembered per (host,
+content-type), and tried ahead of it for the next body from the same place.
+'''
+
+import codecs
+import logging
+import re
+
+# try to import UnicodeDammit from BeautifulSoup,
+# starting with system and defaulting to included version
+# otherwise, set the name to None
+try:
+    try:
+        from BeautifulSoup import UnicodeDammit
+    except ImportError:
+        from ..BeautifulSoup import UnicodeDammit
+except ImportError:
+    UnicodeDammit = None
+    logging.warning('Can\'t find BeautifulSoup, unicode is more likely to be '
+                    'misinterpreted')
+
+# starts of bodies that UnicodeDammit reads differently from a plain decode:
+# byte order marks, UTF-16/32 and EBCDIC XML, and XML declarations, which
+# might name an encoding
+SPECIAL_PREFIXES = ('\xef\xbb\xbf', '\xfe\xff', '\xff\xfe', '\x00\x00',
+                    '\x00<', '<\x00', '\x4c\x6f\xa7\x94', '<?')
+# encodings that UnicodeDammit replaces MS smart quotes (0x80-0x9f) in
+SMART_QUOTE_ENCODINGS = ('windows-1252', 'iso-8859-1', 'iso-8859-2')
+smart_quote_re = re.compile('[\x80-\x9f]')
+
+# (host, content-type) -> encoding the last tier found. Cleared when it
+# reaches MEMO_SIZE entries.
+memo = {}
+MEMO_SIZE = 4096
+
+
+def is_codec(name):
+    '''
+    Returns whether name is None or an encoding python knows by that name.
+    '''
+    if name is None:
+        return True
+    try:
+        codecs.lookup(name)
+    except LookupError:
+        return False
+    return True
+
+
+def try_encoding(body, encoding):
+    '''
+    Returns body decoded strictly from encoding, or None if it isn't in that
+    encoding (or it isn't one UnicodeDammit would decode plainly).
+    '''
+    if (encoding.lower() in SMART_QUOTE_ENCODINGS and
+        smart_quote_re.search(body)):
+        return None
+    try:
+        return body.decode(encoding)
+    except UnicodeError:
+        return None
+
+
+def decode_text(body, charset=None, key=None):
+    '''
+    Decodes a text body.
+
+    Args:
+    body = string, not empty
+    charset = string or None, the charset the content-type declares
+    key = (host, content-type) or None, to remember detected encodings by
+
+    Returns:
+    (text, encoding): unicode or None if it can't be decoded, and the
+    encoding it was decoded from, or None
+    '''
+    if not charset:
+        charset = None
+    plain = not body.startswith(SPECIAL_PREFIXES) and is_codec(charset)
+    if plain and charset:
+        text = try_encoding(body, charset)
+        if text is not None:
+            return text, charset
+        # UnicodeDammit would take the declared charset, smart quotes and all
+        plain = charset.lower() not in SMART_QUOTE_ENCODINGS
+    if plain:
+        text = try_encoding(body, 'utf-8')
+        if text is not None:
+            return text, 'ascii' if len(text) == len(body) else 'utf-8'
+        if key in memo:
+            text = try_encoding(body, memo[key])
+            if text is not None:
+                return text, memo[key]
+    text, encoding = detect(body, charset)
+    if plain and text is not None and key is not None:
+        if len(memo) >= MEMO_SIZE:
+            memo.clear()
+        memo[key] = encoding
+    return text, encoding
+
+
+def detect(body, charset):
+    '''
+    The last tier of decode_text: UnicodeDammit, or a simple guess if it
+    isn't there.
+    '''
+    override_encodings = [charset] if charset else []
+    if UnicodeDammit:
+        # honestly, I don't mind not abiding by RFC 2023.
+        # UnicodeDammit just does what makes sense, and if the
+        # content is remotely standards-compliant, it will do the
+        # right thing.
+        dammit = UnicodeDammit(body, override_encodings)
+        # if unicode was found
+        if dammit.unicode:
+            return dammit.unicode, dammit.originalEncoding
+        # unicode could not be decoded, at all
+        # HAR can't write data, but body might still
+        # be useful as-is
+        return None, None
+    # try the stupid version, just guess content-type or utf-8
+    # try our list of encodings + utf8 with strict errors
+    for e in override_encodings + ['utf8', 'iso-8859-1']:
+        try:
+            return body.decode(e, 'strict') or None, e
+        except (UnicodeError, LookupError):
+            pass
+    # if none of those worked, try utf8
+    # with 'replace' error mode
+    return body.decode('utf8', 'replace') or None, None
+
+
+if __name__ == '__main__':
+    import unittest
+
+    class DecodeTextTest(unittest.TestCase):
+        def setUp(self):
+            memo.clear()
+
+        def test_plain_tiers(self):
+            self.assertEqual(decode_text('hello'), (u'hello', 'ascii'))
+            self.assertEqual(decode_text('caf\xc3\xa9'), (u'caf\xe9', 'utf-8'))
+            self.assertEqual(decode_text('caf\xe9', 'iso-8859-15'),
+                             (u'caf\xe9', 'iso-8859-15'))
+            # a declared charset that doesn't fit falls through to UTF-8
+            self.assertEqual(decode_text('caf\xc3\xa9', 'ascii'),
+                             (u'caf\xe9', 'utf-8'))
+
+        def test_like_detect(self):
+            bodies = ['\xef\xbb\xbfbom', '<?xml version="1.0"?><a/>',
+                      '\x93smart\x94 quotes', 'caf\xe9',
+                      '\xff\xfeu\x00t\x00f\x00']
+            for body in bodies:
+                for declared in (None, 'windows-1252', 'iso-8859-1', 'utf-8',
+                                 'no-such-charset'):
+                    self.assertEqual(decode_text(body, declared)[0],
+                                     detect(body, declared)[0],
+                                     (body, declared))
+
+        def test_memo(self):
+            key = ('example.com', 'text/html')
+            text, encoding = decode_text('caf\xe9', None, key)
+            self.assertEqual(memo[key], encoding)
+            self.assertEqual(decode_text('na\xefve', None, key),
+                             ('na\xefve'.decode(encoding), encoding))
+            assert ('other.com', 'text/html') not in memo
+
+    unittest.main()
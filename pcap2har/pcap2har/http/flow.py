@@ -4,8 +4,12 @@ import dpkt
 import common as http
 from request import Request
 from response import Response
+from .. import dpkt_http_replacement as dpkt_http
 from .. import settings
 
+# ports HTTP servers are usually found on, see request_direction
+SERVER_PORTS = frozenset((80, 3128, 8000, 8008, 8080, 8081, 8888))
+
 
 class Flow(object):
     '''
@@ -24,13 +28,21 @@ class Flow(object):
         '''
         tcpflow = tcp.Flow
         '''
-        # try parsing it with forward as request dir
-        success, requests, responses = parse_streams(tcpflow.fwd, tcpflow.rev)
-        if not success:
-            success, requests, responses = parse_streams(tcpflow.rev, tcpflow.fwd)
-            if not success:
-                # flow is not HTTP
-                raise HTTPError('TCP Flow does not contain HTTP')
+        if tcpflow.fwd.parser is not None:
+            # messages were parsed as the data arrived, see http.stream
+            request_parser = tcpflow.fwd.parser
+            response_parser = tcpflow.rev.parser
+            if (request_parser.MessageClass is Response or
+                response_parser.MessageClass is Request):
+                request_parser, response_parser = (response_parser,
+                                                   request_parser)
+            requests = streamed_messages(request_parser)
+            responses = streamed_messages(response_parser)
+        else:
+            request_dir, response_dir = request_direction(
+                tcpflow, tcpflow.fwd.data, tcpflow.rev.data)
+            requests = gather_messages(Request, request_dir)
+            responses = gather_messages(Response, response_dir)
         # now optionally clear the data on tcpflow
         if settings.drop_bodies:
             tcpflow.fwd.clear_data()
@@ -42,6 +54,8 @@ class Flow(object):
         # determine a list of responses that we can match up with requests,
         # padding the list with None where necessary.
         try:
+            if not requests:
+                raise LookupError('no requests')
             # find the first response to a request we know about,
             # that is, the first response after the first request
             first_response_index = find_index(
@@ -73,6 +87,8 @@ class Flow(object):
                 connected = True
             else:
                 req.ts_connect = req.ts_start
+            if resp:
+                resp.host = req.host
             self.pairs.append(MessagePair(req, resp))
 
 
@@ -125,26 +141,105 @@ def gather_messages(MessageClass, tcpdir):
     return messages
 
 
-def parse_streams(request_stream, response_stream):
+def streamed_messages(parser):
+    '''
+    Returns the messages an http.StreamParser found, raising http.Error like
+    gather_messages if the stream wasn't HTTP to begin with.
+    '''
+    if parser.invalid:
+        raise http.Error('Invalid http')
+    return parser.messages
+
+
+def message_kind(data):
+    '''
+    Guesses from the first bytes of a stream whether it holds requests or
+    responses. Returns Request, Response or None.
+    '''
+    if not data:
+        return None
+    if data.startswith('HTTP/'):
+        return Response
+    token = data[:20].split(None, 1)
+    if token and token[0] in dpkt_http.Request.methods:
+        return Request
+    return None
+
+
+def could_be_http(data):
     '''
-    attempts to construct http.Request/Response's from the corresponding
-    passed streams. Failure may either mean that the streams are malformed or
-    they are simply switched
+    Whether data, the first bytes of a stream, could be the start of an HTTP
+    message. Data that's cut short in the middle of the first word passes if
+    it's the start of a method or 'HTTP/'.
+    '''
+    start = data.lstrip()[:20]
+    if not start or message_kind(start) is not None:
+        return True
+    token = start.split(None, 1)[0]
+    if token != start:
+        return False  # a whole word, and not one of ours
+    if 'HTTP/'.startswith(token):
+        return True
+    for method in dpkt_http.Request.methods:
+        if method.startswith(token):
+            return True
+    return False
+
+
+def sniff(tcpflow, data):
+    '''
+    Decides whether a tcp.Flow is worth keeping data for, from the first data
+    in it (see tcp.Flow.sniffer). Flows on settings.http_ports are always
+    kept, flows on settings.non_http_ports never are, and anything else is
+    kept if the data looks like HTTP (see could_be_http).
+    '''
+    if tcpflow.socket:
+        ports = (tcpflow.socket[0][1], tcpflow.socket[1][1])
+        for port in ports:
+            if port in settings.http_ports:
+                return True
+        for port in ports:
+            if port in settings.non_http_ports:
+                return False
+    return could_be_http(data)
+
+
+def request_direction(tcpflow, fwd_data=None, rev_data=None):
+    '''
+    Decides which direction of a tcp.Flow carries the requests, without
+    parsing anything, so that the flow only needs to be parsed once. In order
+    of preference, goes by:
+    * the handshake: whoever sent the SYN is the client
+    * the first bytes of each direction, see message_kind
+    * the ports: a well-known HTTP port, or else the lower port, is the
+      server's
     Args:
-    request_stream, response_stream = TCPDirection
+    tcpflow = tcp.Flow
+    fwd_data, rev_data = string or None, the start of the data in each
+      direction, as far as it's known
     Returns:
-    True or False, whether parsing succeeded
-    request list or None
-    response list or None
-    '''
-    try:
-        requests = gather_messages(Request, request_stream)
-        responses = gather_messages(Response, response_stream)
-    except dpkt.UnpackError as e:
-        print 'failed to parse http: ', e
-        return False, None, None
-    else:
-        return True, requests, responses
+    (request tcp.Direction, response tcp.Direction)
+    '''
+    forward = (tcpflow.fwd, tcpflow.rev)
+    backward = (tcpflow.rev, tcpflow.fwd)
+    if tcpflow.handshake:
+        return forward
+    fwd_kind = message_kind(fwd_data)
+    rev_kind = message_kind(rev_data)
+    if fwd_kind is Request or rev_kind is Response:
+        return forward
+    if fwd_kind is Response or rev_kind is Request:
+        return backward
+    if tcpflow.socket:
+        (src, sport), (dst, dport) = tcpflow.socket
+        server_ports = SERVER_PORTS.union(settings.http_ports)
+        if dport in server_ports and sport not in server_ports:
+            return forward
+        if sport in server_ports and dport not in server_ports:
+            return backward
+        if sport < dport:
+            return backward
+    return forward
 
 
 def find_index(f, seq):
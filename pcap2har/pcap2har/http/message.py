@@ -15,19 +15,30 @@ class Message(object):
     * tcpdir: The tcp.Direction corresponding to the HTTP message
     '''
 
-    def __init__(self, tcpdir, pointer, msgclass):
+    def __init__(self, tcpdir, pointer, msgclass, buf=None, offset=None,
+                 msg=None):
         '''
         Args:
         tcpdir = tcp.Direction
         pointer = position within tcpdir.data to start parsing from. byte index
         msgclass = dpkt.http.Request/Response
+        buf, offset = where to parse the message from, if not tcpdir.data and
+          pointer. For when the stream's data isn't kept, see http.stream.
+        msg = msgclass, already parsed, with end set to its length in the
+          stream, in place of buf. See headers-only mode in http.stream.
         '''
         self.tcpdir = tcpdir
-        # attempt to parse as http. let exception fall out to caller
-        self.msg = msgclass(tcpdir.data[pointer:])
-        self.data_consumed = (len(tcpdir.data) - pointer) - len(self.msg.data)
-        # save memory by deleting data attribute; it's useless
-        self.msg.data = None
+        if msg is not None:
+            self.msg = msg
+            offset = 0
+        else:
+            if buf is None:
+                buf, offset = tcpdir.data, pointer
+            # attempt to parse as http. let exception fall out to caller. the
+            # stream is parsed in place, so the rest of it isn't copied for
+            # every message.
+            self.msg = msgclass(buf, offset)
+        self.data_consumed = self.msg.end - offset
         # calculate sequence numbers of data
         self.seq_start = tcpdir.byte_to_seq(pointer)
         self.seq_end = tcpdir.byte_to_seq(pointer + self.data_consumed) # past-the-end
@@ -38,16 +49,3 @@ class Message(object):
             logging.warn('Got an HTTP message with unknown start or end time.')
         # get raw body
         self.raw_body = self.msg.body
-        self.__pointer = pointer
-        # Access self.__raw_msg via raw_msg @property, which will set it if None
-        self.__raw_msg = None
-
-    @property
-    def raw_msg(self):
-        '''
-        Returns the message (including header) as a byte string.
-        '''
-        if not self.__raw_msg:
-          self.__raw_msg = self.tcpdir.data[
-              self.__pointer:(self.__pointer+self.data_consumed)]
-        return self.__raw_msg
@@ -2,9 +2,6 @@ import urlparse
 
 # dpkt.http is buggy, so we use our modified replacement
 from .. import dpkt_http_replacement as dpkt_http
-import message as http
-from .. import settings
-from ..mediatype import MediaType
 from response import Response
 from base64 import b64decode
 
@@ -18,32 +15,47 @@ class Request(Response):
     * url: Full URL, but without fragments. (that's what HAR wants)
     '''
 
-    def __init__(self, tcpdir, pointer):
-        http.Message.__init__(self, tcpdir, pointer, dpkt_http.Request)
-        if 'content-type' in self.msg.headers:
-            self.mediaType = MediaType(self.msg.headers['content-type'])
-        else:
-            self.mediaType = MediaType('application/x-unknown-content-type')
-        self.mimeType = self.mediaType.mimeType()
-        # first guess at body size. handle_compression might
-        # modify it, but this has to be before clear_body
-        self.body_length = len(self.msg.body)
-        self.compression_amount = None
-        self.text = None
-        # handle body stuff
-        if settings.drop_bodies:
-            self.clear_body()
-        else:
-            # uncompress body if necessary
-            self.handle_compression()
-            # try to get out unicode
-            self.handle_text()
-        if self.mimeType == 'application/x-www-form-urlencoded':
+    msgclass = dpkt_http.Request
+
+    def __init__(self, tcpdir, pointer, buf=None, offset=None, msg=None):
+        Response.__init__(self, tcpdir, pointer, buf, offset, msg)
+        self.host = dpkt_http.header_value(self.msg.headers, 'host', '')
+        self.__url = None
+
+    def decode(self, text=True, limit=None):
+        '''
+        See Response.decode.
+        '''
+        if self.decoded:
+            return
+        Response.decode(self, text, limit)
+        if (self.mimeType == 'application/x-www-form-urlencoded' and
+            self.text is not None):
             self.text = b64decode(self.text)
-        # get query string. its the URL after the first '?'
-        uri = urlparse.urlparse(self.msg.uri)
-        self.host = self.msg.headers['host'] if 'host' in self.msg.headers else ''
-        fullurl = urlparse.ParseResult('http', self.host, uri.path, uri.params, uri.query, uri.fragment)
-        self.fullurl = fullurl.geturl()
-        self.url, frag = urlparse.urldefrag(self.fullurl)
-        self.query = urlparse.parse_qs(uri.query, keep_blank_values=True)
+
+    def parse_url(self):
+        '''
+        Works out fullurl, url and query from the request URI, the first time
+        any of them is asked for.
+        '''
+        if self.__url is None:
+            # get query string. its the URL after the first '?'
+            uri = urlparse.urlparse(self.msg.uri)
+            fullurl = urlparse.ParseResult('http', self.host, uri.path, uri.params, uri.query, uri.fragment)
+            fullurl = fullurl.geturl()
+            url, frag = urlparse.urldefrag(fullurl)
+            query = urlparse.parse_qs(uri.query, keep_blank_values=True)
+            self.__url = (fullurl, url, query)
+        return self.__url
+
+    @property
+    def fullurl(self):
+        return self.parse_url()[0]
+
+    @property
+    def url(self):
+        return self.parse_url()[1]
+
+    @property
+    def query(self):
+        return self.parse_url()[2]
@@ -1,66 +1,199 @@
-import gzip
 import zlib
-import cStringIO
 from base64 import encodestring as b64encode
+import json
 import logging
 
 from .. import dpkt_http_replacement as dpkt_http
-from ..mediatype import MediaType
+from .. import mediatype
 from .. import settings
 
+import charset
 import common as http
 import message
 
-# try to import UnicodeDammit from BeautifulSoup,
-# starting with system and defaulting to included version
-# otherwise, set the name to None
-try:
+# zlib window bits for gzip and raw deflate streams
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# NOTE: wbits = -15 is a undocumented feature in python (it's documented in
+# zlib) that gets rid of the header so we can do raw deflate.
+# See: http://bugs.python.org/issue5784
+DEFLATE_WBITS = -15
+# how much output to ask zlib for at a time
+INFLATE_STEP = 256 * 1024
+
+
+def stream_ended(decompressor):
+    '''
+    Returns whether a zlib decompressor that has been given all of its data
+    got to the end of the stream. Python 2's decompressobj doesn't say, but
+    once the stream has ended, any more input is left over as unused_data.
+    '''
+    probe = decompressor.copy()
+    try:
+        probe.decompress('\x00')
+    except zlib.error:
+        return False
+    return bool(probe.unused_data)
+
+
+def inflate_pieces(data, wbits):
+    '''
+    Generator that decompresses data a step at a time, yielding the output in
+    pieces of no more than about INFLATE_STEP bytes. Gzip data may have
+    several members, which are decompressed one after another. Raises
+    zlib.error if the data is corrupt, or ends before the stream does, once
+    whatever could be decompressed has been yielded.
+    '''
+    while data:
+        decompressor = zlib.decompressobj(wbits)
+        while data and not decompressor.unused_data:
+            yield decompressor.decompress(data, INFLATE_STEP)
+            data = decompressor.unconsumed_tail
+        # once the stream has ended, there's nothing left to flush, and
+        # python 2.7's flush() would append unconsumed_tail to unused_data a
+        # second time
+        data = decompressor.unused_data
+        if not data:
+            ended = stream_ended(decompressor)
+            yield decompressor.flush()
+            if not ended:
+                raise zlib.error('incomplete or truncated stream')
+        if wbits != GZIP_WBITS or not data.startswith('\x1f\x8b'):
+            break
+
+
+def inflate(data, wbits, limit=None):
+    '''
+    Decompresses data without ever holding more than limit bytes of output.
+    Output past the limit is only counted.
+
+    Data that is corrupt or cut short still decompresses to whatever came
+    before the problem. Only if nothing does is zlib.error raised.
+
+    Args:
+    data = string, compressed data
+    wbits = GZIP_WBITS or DEFLATE_WBITS
+    limit = int or None
+
+    Returns:
+    (output, size, error): output, cut off at limit, its full length, and
+    the zlib.error that stopped decompression early, or None
+    '''
+    pieces = []
+    kept = 0
+    size = 0
     try:
-        from BeautifulSoup import UnicodeDammit
-    except ImportError:
-        from ..BeautifulSoup import UnicodeDammit
-except ImportError:
-    UnicodeDammit = None
-    log.warning('Can\'t find BeautifulSoup, unicode is more likely to be '
-                'misinterpreted')
+        for piece in inflate_pieces(data, wbits):
+            size += len(piece)
+            if limit is not None and kept + len(piece) > limit:
+                piece = piece[:limit - kept]
+            if piece:
+                pieces.append(piece)
+                kept += len(piece)
+    except zlib.error as error:
+        if not size:
+            raise
+        return ''.join(pieces), size, error
+    return ''.join(pieces), size, None
+
 
 class Response(message.Message):
     '''
     HTTP response.
+
+    Construction only frames the message and reads its headers. Everything
+    that depends on the body (decompression, charset detection, base64) is
+    put off until decode() is called, which har does when the message is
+    written out, so it isn't done for messages that are never used. Until
+    then, body_length is the length of the raw body, and text is None.
+
     Members:
     * mediaType: mediatype.MediaType, constructed from content-type
     * mimeType: string mime type of returned data
     * body: http decoded body data, otherwise unmodified
     * text: body text, unicoded if possible, otherwise base64 encoded
+    * json: parsed JSON body, if settings.parse_json_bodies is on and the
+      body is JSON and all there, otherwise None
     * encoding: 'base64' if self.text is base64 encoded binary data, else None
     * compression: string, compression type
     * original_encoding: string, original text encoding/charset/whatever
     * body_length: int, length of body, uncompressed if possible/applicable
     * compression_amount: int or None, difference between lengths of
       uncompressed data and raw data. None if no compression or we're not sure
+    * body_truncated: bool, whether body was cut short because it decompressed
+      to more than settings.max_decompressed_body
+    * body_incomplete: bool, whether the compressed data was cut short or
+      corrupt, so body is only what decompressed before the problem
+    * text_truncated: bool, whether text was cut short, see handle_text
+    * decoded: bool, whether decode() has been called
+    * host: string or None, host of the request the response answers, set
+      when they're paired up. Charset detection is remembered per host.
     '''
 
-    def __init__(self, tcpdir, pointer):
-        message.Message.__init__(self, tcpdir, pointer, dpkt_http.Response)
-        # get mime type
-        if 'content-type' in self.msg.headers:
-            self.mediaType = MediaType(self.msg.headers['content-type'])
-        else:
-            self.mediaType = MediaType('application/x-unknown-content-type')
-        self.mimeType = self.mediaType.mimeType()
+    msgclass = dpkt_http.Response
+
+    def __init__(self, tcpdir, pointer, buf=None, offset=None, msg=None):
+        message.Message.__init__(self, tcpdir, pointer, self.msgclass, buf,
+                                 offset, msg)
+        self.__mediaType = None
         # first guess at body size. handle_compression might
         # modify it, but this has to be before clear_body
-        self.body_length = len(self.msg.body)
+        self.body_length = self.msg.body_length
         self.compression_amount = None
         self.text = None
-        # handle body stuff
-        if settings.drop_bodies:
+        self.json = None
+        self.host = None
+        self.body_truncated = False
+        self.body_incomplete = False
+        self.text_truncated = False
+        self.decoded = False
+        if settings.drop_bodies or self.msg.body is None:
             self.clear_body()
-        else:
-            # uncompress body if necessary
+
+    @property
+    def mediaType(self):
+        '''
+        mediatype.MediaType from the content-type header, looked up when
+        first asked for. Shared with other messages, see mediatype.lookup.
+        '''
+        if self.__mediaType is None:
+            if 'content-type' in self.msg.headers:
+                self.__mediaType = mediatype.lookup(
+                    dpkt_http.header_value(self.msg.headers, 'content-type'))
+            else:
+                self.__mediaType = mediatype.lookup(
+                    'application/x-unknown-content-type')
+        return self.__mediaType
+
+    @property
+    def mimeType(self):
+        return self.mediaType.mimeType()
+
+    def decode(self, text=True, limit=None):
+        '''
+        Does the expensive work on the body: uncompresses it and works out its
+        text. Only the first call does anything.
+
+        Args:
+        text = bool, whether to work out the text, or only uncompress
+        limit = int or None, most bytes of text to keep, see handle_text
+        '''
+        if self.decoded:
+            return
+        self.decoded = True
+        if self.raw_body is None:
+            return  # body was dropped
+        # uncompress body if necessary
+        try:
             self.handle_compression()
-            # try to get out unicode
-            self.handle_text()
+        except http.DecodingError as error:
+            # too late to drop the message now, so make do with the raw body
+            logging.warning(error)
+            self.body = self.raw_body
+            self.body_length = len(self.body)
+            self.compression_amount = None
+        # try to get out unicode
+        if text:
+            self.handle_text(limit)
 
     def clear_body(self):
         '''
@@ -76,31 +209,33 @@ class Response(message.Message):
         '''
         Sets self.body to the http decoded response data. Sets compression to
         the name of the compresson type.
+
+        Decompressed bodies are cut off at settings.max_decompressed_body
+        bytes, and flagged with body_truncated, but body_length is still their
+        full size. Compressed data that is cut short or corrupt partway is
+        decompressed as far as it goes, and flagged with body_incomplete.
         '''
+        size = None
+        error = None
         # if content-encoding is found
         if 'content-encoding' in self.msg.headers:
-            encoding = self.msg.headers['content-encoding'].lower()
+            encoding = dpkt_http.header_value(
+                self.msg.headers, 'content-encoding').lower()
             self.compression = encoding
             # handle gzip
             if encoding == 'gzip' or encoding == 'x-gzip':
                 try:
-                    gzipfile = gzip.GzipFile(
-                        fileobj = cStringIO.StringIO(self.raw_body)
-                    )
-                    self.body = gzipfile.read()
+                    self.body, size, error = inflate(
+                        self.raw_body, GZIP_WBITS,
+                        settings.max_decompressed_body)
                 except zlib.error:
                     raise http.DecodingError('zlib failed to gunzip HTTP data')
-                except:
-                    # who knows what else it might raise
-                    raise http.DecodingError(
-                        'failed to gunzip HTTP data, don\'t know why')
             # handle deflate
             elif encoding == 'deflate':
                 try:
-                    # NOTE: wbits = -15 is a undocumented feature in python (it's
-                    # documented in zlib) that gets rid of the header so we can
-                    # do raw deflate. See: http://bugs.python.org/issue5784
-                    self.body = zlib.decompress(self.raw_body, -15)
+                    self.body, size, error = inflate(
+                        self.raw_body, DEFLATE_WBITS,
+                        settings.max_decompressed_body)
                 except zlib.error:
                     raise http.DecodingError(
                         'zlib failed to undeflate HTTP data')
@@ -122,69 +257,80 @@ class Response(message.Message):
             # no compression
             self.compression = 'identity'
             self.body = self.raw_body
-        self.body_length = len(self.body)
+        if error is not None:
+            logging.warning('HTTP body is cut short or corrupt (%s), keeping '
+                            'the %d bytes it decompressed to', error, size)
+            self.body_incomplete = True
+        if size is None:
+            size = len(self.body)
+        elif size > len(self.body):
+            logging.warning('HTTP body decompresses to %d bytes, keeping only '
+                            'the first %d', size, len(self.body))
+            self.body_truncated = True
+        self.body_length = size
         # comp_amount is 0 when no compression, which may or may not be to spec
         self.compression_amount = self.body_length - len(self.raw_body)
 
-    def handle_text(self):
+    @property
+    def is_text(self):
+        '''
+        Whether the body is text (text/*, JSON or XML), as opposed to binary
+        data that gets base64 encoded.
+        '''
+        return bool(self.mediaType and
+                    (self.mediaType.type == 'text' or
+                     self.mediaType.is_json() or
+                     (self.mediaType.type == 'application' and
+                      'xml' in self.mediaType.subtype)))
+
+    def handle_text(self, limit=None):
         '''
         Takes care of converting body text to unicode, if its text at all.
         Sets self.original_encoding to original char encoding, and converts body
-        to unicode if possible. Must come after handle_compression, and after
-        self.mediaType is valid.
+        to unicode if possible, see http.charset. Must come after
+        handle_compression, and after self.mediaType is valid.
+
+        JSON counts as text too, and is parsed into self.json if
+        settings.parse_json_bodies is on.
+
+        If limit is given, text is cut down to what fits into limit bytes (of
+        UTF-8, or of binary data before base64), and text_truncated is set.
         '''
         self.encoding = None
         # if the body is text
-        if (self.mediaType and
-            (self.mediaType.type == 'text' or
-                (self.mediaType.type == 'application' and
-                 'xml' in self.mediaType.subtype))):
-            # if there was a charset parameter in HTTP header, store it
-            if 'charset' in self.mediaType.params:
-                override_encodings = [self.mediaType.params['charset']]
-            else:
-                override_encodings = []
+        if self.is_text:
             # if there even is data (otherwise,
-            # dammit.originalEncoding might be None)
+            # the original encoding might be None)
             if self.body != '':
-                if UnicodeDammit:
-                    # honestly, I don't mind not abiding by RFC 2023.
-                    # UnicodeDammit just does what makes sense, and if the
-                    # content is remotely standards-compliant, it will do the
-                    # right thing.
-                    dammit = UnicodeDammit(self.body, override_encodings)
-                    # if unicode was found
-                    if dammit.unicode:
-                        self.text = dammit.unicode
-                        self.originalEncoding = dammit.originalEncoding
-                    else:
-                        # unicode could not be decoded, at all
-                        # HAR can't write data, but body might still
-                        # be useful as-is
-                        pass
-                else:
-                    # try the stupid version, just guess content-type or utf-8
-                    u = None
-                    # try our list of encodings + utf8 with strict errors
-                    for e in override_encodings + ['utf8', 'iso-8859-1']:
-                        try:
-                            u = self.body.decode(e, 'strict')
-                            self.originalEncoding = e
-                            break  # if ^^ didn't throw, we're done
-                        except UnicodeError:
-                            pass
-                    # if none of those worked, try utf8
-                    # with 'replace' error mode
-                    if not u:
-                        # unicode has failed
-                        u = self.body.decode('utf8', 'replace')
-                        self.originalEncoding = None  # ???
-                    self.text = u or None
+                self.text, self.originalEncoding = charset.decode_text(
+                    self.body, self.mediaType.params.get('charset'),
+                    (self.host, dpkt_http.header_value(
+                        self.msg.headers, 'content-type')))
+                if (limit is not None and self.text and
+                    len(self.text) > limit / 4):
+                    utf8 = self.text.encode('utf8')
+                    if len(utf8) > limit:
+                        # drop whatever character got cut in half
+                        self.text = utf8[:limit].decode('utf8', 'ignore')
+                        self.text_truncated = True
+                # JSON that isn't all there wouldn't parse anyway
+                if (settings.parse_json_bodies and self.text and
+                    not (self.text_truncated or self.body_truncated or
+                         self.body_incomplete) and
+                    self.mediaType.is_json()):
+                    try:
+                        self.json = json.loads(self.text)
+                    except ValueError as error:
+                        logging.warning('invalid JSON body: %s', error)
         else:
             # body is not text
             # base64 encode it and set self.encoding
             # TODO: check with list that this is right
-            self.text = b64encode(self.body)
+            body = self.body
+            if limit is not None and len(body) > limit:
+                body = body[:limit]
+                self.text_truncated = True
+            self.text = b64encode(body)
             self.encoding = 'base64'
 
     @property
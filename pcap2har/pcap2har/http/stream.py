@@ -0,0 +1,460 @@
+import logging
+
+import dpkt
+
+from .. import dpkt_http_replacement as dpkt_http
+from .. import settings
+from request import Request
+from response import Response
+import flow
+
+# framing states, see StreamParser
+START_LINE = 'start line'
+HEADERS = 'headers'
+BODY_LENGTH = 'body'  # counting down a content-length
+CHUNK_SIZE = 'chunk size'
+CHUNK_DATA = 'chunk data'
+CHUNK_END = 'chunk end'  # the line after a chunk's data
+TRAILERS = 'trailers'  # header lines after the last chunk
+UNTIL_CLOSE = 'until close'  # body runs to the end of the stream
+DONE = 'done'
+
+
+class StreamParser(object):
+    '''
+    Parses HTTP messages out of a tcp.Direction while its data is still
+    arriving, instead of from the whole stream once it's finished.
+
+    Attach it as the direction's parser, and the direction feeds it data as
+    soon as it's in order (see tcp.Direction.feed_parser) and drops the data
+    afterwards. Only the message currently being received is buffered. A
+    small state machine follows the message's framing (start line, headers,
+    then a body of content-length bytes, in chunks or up to the end of the
+    stream). As soon as the message is complete, it is parsed by MessageClass
+    exactly as it would have been from the whole stream, and the data it took
+    up is let go.
+
+    Like http.flow.gather_messages, parsing stops at the first bad message.
+    If that is the very first message, the stream isn't HTTP.
+
+    If MessageClass isn't given, it's decided when the first data arrives in
+    either direction of the flow, by http.flow.request_direction, for the
+    parsers of both directions at once.
+
+    In headers-only mode, bodies aren't kept at all. The framing state
+    machine already reads the start line and headers, so messages are built
+    from those, and the body is only counted as it goes by. Since the
+    tcp.Direction drops data once it has been fed in, that leaves nothing of
+    the body in memory but its size and the arrival times of its sequence
+    numbers. The messages have a body of None and the right body_length.
+
+    Members:
+    * tcpdir = tcp.Direction the data comes from
+    * MessageClass = http.Request or http.Response, or None while undecided
+    * messages = [MessageClass], complete messages, in order
+    * failed = bool, whether parsing stopped on bad data
+    * invalid = bool, whether the first message was bad
+    * pointer = byte index in the stream of the start of the current message
+    * pieces = [string], data of the current message received so far. Not
+      used in headers-only mode.
+    * state = framing state of the current message
+    * headers_only = bool, whether bodies are skipped
+    '''
+
+    def __init__(self, tcpdir, MessageClass=None, headers_only=None):
+        '''
+        Args:
+        tcpdir = tcp.Direction, for sequence numbers and arrival times
+        MessageClass = http.Request, http.Response or None
+        headers_only = bool, defaults to settings.drop_bodies
+        '''
+        if headers_only is None:
+            headers_only = settings.drop_bodies
+        self.tcpdir = tcpdir
+        self.MessageClass = MessageClass
+        self.headers_only = headers_only
+        self.messages = []
+        self.failed = False
+        self.invalid = False
+        self.pointer = 0
+        self.pieces = []
+        self.reset_framing()
+
+    def reset_framing(self):
+        '''
+        Gets ready to frame a new message.
+        '''
+        self.state = START_LINE
+        self.pending = ''  # data that framing hasn't got through yet
+        self.head = None  # the message's start line and headers
+        self.head_lines = []
+        self.remaining = 0  # bytes left in the body or chunk
+        self.chunk_size = 0
+        self.framed = 0  # bytes of the message framed so far
+        self.body_length = 0  # body bytes framed, as dpkt_http would count
+        self.error = None  # why framing stopped, if the message is bad
+
+    def feed(self, data):
+        '''
+        Adds the next bit of in-order data from the stream.
+        '''
+        if self.failed or not data:
+            return
+        if self.MessageClass is None:
+            self.decide(data)
+        if not self.headers_only:
+            self.pieces.append(data)
+        while self.frame(data):
+            data = self.complete()
+            if not data:
+                break
+
+    def decide(self, data):
+        '''
+        Sets MessageClass on the parsers of both directions of the flow, from
+        the first data in this one.
+        '''
+        tcpflow = self.tcpdir.flow
+        if self.tcpdir is tcpflow.fwd:
+            request_dir, response_dir = flow.request_direction(
+                tcpflow, data, None)
+        else:
+            request_dir, response_dir = flow.request_direction(
+                tcpflow, None, data)
+        if request_dir.parser:
+            request_dir.parser.MessageClass = Request
+        if response_dir.parser:
+            response_dir.parser.MessageClass = Response
+
+    def frame(self, data):
+        '''
+        Runs the framing state machine over data, the newest data of the
+        current message. Returns whether the message is complete, or whatever
+        it holds should be handed to MessageClass right away because it's
+        malformed.
+        '''
+        buf = self.pending + data if self.pending else data
+        i = 0
+        while self.state != DONE:
+            state = self.state
+            if state == BODY_LENGTH or state == CHUNK_DATA:
+                taken = min(self.remaining, len(buf) - i)
+                i += taken
+                self.remaining -= taken
+                if state == BODY_LENGTH:
+                    self.body_length += taken
+                if self.remaining:
+                    break
+                if state == BODY_LENGTH:
+                    self.state = DONE
+                else:
+                    self.state = CHUNK_END
+                continue
+            if state == UNTIL_CLOSE:
+                self.body_length += len(buf) - i
+                i = len(buf)
+                break
+            # everything else goes line by line
+            end = buf.find('\n', i)
+            if end < 0:
+                break
+            line = buf[i:end+1]
+            i = end + 1
+            try:
+                if self.frame_line(line) is False:
+                    i -= len(line)  # it's the next message's
+            except dpkt.Error as error:
+                self.error = error
+                self.state = DONE
+        self.framed += i
+        self.pending = buf[i:]
+        return self.state == DONE
+
+    def frame_line(self, line):
+        '''
+        Moves the state machine along by one line of data. Raises dpkt.Error
+        if the message is malformed. Returns False if the line isn't part of
+        the message after all, which ended just before it.
+        '''
+        state = self.state
+        if state == START_LINE:
+            self.head = self.MessageClass.msgclass()
+            self.head.unpack_start_line(line)
+            self.state = HEADERS
+        elif state == HEADERS:
+            if line.strip():
+                self.head_lines.append(line)
+                return
+            self.head.headers = dpkt_http.parse_header_lines(self.head_lines)
+            framing, length = dpkt_http.body_framing(self.head, warn=False)
+            if framing == dpkt_http.BODY_CHUNKED:
+                self.state = CHUNK_SIZE
+            elif framing == dpkt_http.BODY_LENGTH:
+                self.remaining = length
+                self.state = BODY_LENGTH
+            elif framing == dpkt_http.BODY_UNTIL_CLOSE:
+                self.state = UNTIL_CLOSE
+            else:
+                self.state = DONE
+        elif state == CHUNK_SIZE:
+            # same rules as dpkt_http.parse_chunked
+            self.chunk_size = dpkt_http.parse_chunk_size(line, warn=False)
+            if self.chunk_size:
+                self.remaining = self.chunk_size
+                self.state = CHUNK_DATA
+            else:
+                self.state = TRAILERS
+        elif state == CHUNK_END:
+            if line.strip():
+                self.state = DONE  # not a chunk after all
+            else:
+                self.body_length += self.chunk_size
+                self.state = CHUNK_SIZE
+        elif state == TRAILERS:
+            # same rules as dpkt_http.parse_chunked, which only needs to
+            # check the trailers if the message is parsed from the data
+            if self.headers_only:
+                added = dpkt_http.add_trailer(self.head.headers, line)
+            else:
+                added = dpkt_http.add_trailer({}, line, warn=False)
+            if not added:
+                self.state = DONE
+                if added is None:
+                    return False
+
+    def complete(self):
+        '''
+        Parses the current message from the data received for it, and starts
+        on the next one. Returns whatever data came after the message.
+        '''
+        if self.headers_only:
+            return self.complete_head()
+        data = ''.join(self.pieces)
+        self.pieces = []
+        self.reset_framing()
+        try:
+            msg = self.MessageClass(self.tcpdir, self.pointer, data, 0)
+        except dpkt.Error as error:
+            self.fail(error)
+            return ''
+        self.messages.append(msg)
+        self.pointer += msg.data_consumed
+        rest = data[msg.data_consumed:]
+        if rest:
+            self.pieces.append(rest)
+        return rest
+
+    def complete_head(self):
+        '''
+        complete(), for headers-only mode: makes the message out of the start
+        line and headers that framing parsed.
+        '''
+        head, error, rest = self.head, self.error, self.pending
+        length, framed = self.body_length, self.framed
+        self.reset_framing()
+        if error is not None:
+            self.fail(error)
+            return ''
+        head.body = None
+        head.body_length = length
+        head.end = framed
+        msg = self.MessageClass(self.tcpdir, self.pointer, msg=head)
+        self.messages.append(msg)
+        self.pointer += msg.data_consumed
+        return rest
+
+    def finish(self):
+        '''
+        Called at the end of the stream. Parses whatever is left, the way
+        http.flow.gather_messages would.
+        '''
+        if self.failed:
+            return
+        if self.headers_only:
+            self.finish_head()
+            return
+        data = ''.join(self.pieces)
+        self.pieces = []
+        offset = 0
+        while offset < len(data):
+            try:
+                msg = self.MessageClass(self.tcpdir, self.pointer, data,
+                                        offset)
+            except dpkt.Error as error:
+                self.fail(error)
+                break
+            self.messages.append(msg)
+            offset += msg.data_consumed
+            self.pointer += msg.data_consumed
+        self.state = DONE
+
+    def finish_head(self):
+        '''
+        finish(), for headers-only mode. The end of the stream ends whatever
+        line, headers or body were still open, with the same outcome as
+        dpkt_http reading the message up to the end of the data.
+        '''
+        state = self.state
+        if state == START_LINE and not self.pending:
+            self.state = DONE
+            return
+        line = self.pending
+        self.framed += len(line)
+        self.pending = ''
+        try:
+            if state in (START_LINE, HEADERS) and line:
+                self.frame_line(line)
+                line = ''
+            if self.state == HEADERS:
+                self.frame_line('')  # headers end where the data does
+            state = self.state
+            if state == BODY_LENGTH and self.remaining:
+                logging.warn('HTTP content-length mismatch: expected %d, '
+                             'got %d', self.body_length + self.remaining,
+                             self.body_length)
+                if settings.strict_http_parse_body:
+                    raise dpkt.NeedData('short body (missing %d bytes)' %
+                                        self.remaining)
+            elif state == TRAILERS:
+                if line and self.frame_line(line) is False:
+                    self.framed -= len(line)
+                    self.pending = line  # see below
+            elif state == CHUNK_END and line.strip():
+                pass  # the last chunk gets dropped, see frame_line
+            elif state in (CHUNK_SIZE, CHUNK_DATA, CHUNK_END):
+                if state == CHUNK_SIZE and line:
+                    self.frame_line(line)  # raises if there's no size
+                elif state == CHUNK_END:
+                    self.body_length += self.chunk_size
+                if self.state != TRAILERS:
+                    missing = self.remaining if self.state == CHUNK_DATA else 0
+                    logging.warn('premature end of chunked body (missing %d '
+                                 'bytes of the last chunk, and any chunks '
+                                 'after it)', missing)
+                    if settings.strict_http_parse_body:
+                        raise dpkt.NeedData('premature end of chunked body')
+        except dpkt.Error as error:
+            self.error = error
+        rest = self.complete_head()
+        if rest:
+            # a line that ended the trailers starts another message
+            self.pending = rest
+            self.finish_head()
+            return
+        self.state = DONE
+
+    def fail(self, error):
+        '''
+        Stops parsing, on account of a bad message.
+        '''
+        logging.warning(error)
+        if self.messages:
+            logging.warning('We got a dpkt.Error %s, but we are done.' % error)
+        else:
+            self.invalid = True
+        self.failed = True
+        self.pieces = []
+        self.state = DONE
+
+
+if __name__ == '__main__':
+    import random
+    import unittest
+
+    from ..pcaputil import FakeStream
+    import common
+
+    # FakeStream has no arrival times, which every message warns about
+    logging.disable(logging.WARNING)
+
+    REQUESTS = [
+        'GET /a HTTP/1.1\r\nHost: x\r\n\r\n',
+        'POST /b HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\nhello',
+        'PUT /c HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n'
+        '3\r\nabc\r\n2;ext\r\nde\r\n0\r\nX-T: 1\r\n\r\n',
+    ]
+    RESPONSES = [
+        'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nabc',
+        'HTTP/1.1 204 No Content\r\nContent-Length: 3\r\n\r\n',
+        'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+        '4\r\nwxyz\r\n0\r\n\r\n',
+        'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nab\r\n0\r\n',
+        'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nshort',
+        'HTTP/1.1 200 OK\r\nContent-Length: -1\r\n\r\n',
+        'HTTP/1.0 200 OK\r\n\r\nto the end',
+    ]
+
+    def describe(msg):
+        return (msg.data_consumed, msg.msg.headers, msg.msg.body_length,
+                msg.seq_start, msg.seq_end)
+
+    def batch_parse(MessageClass, data):
+        return [describe(msg) for msg in
+                flow.gather_messages(MessageClass, FakeStream(data))]
+
+    def stream_parse(MessageClass, data, sizes, headers_only=False):
+        parser = StreamParser(FakeStream(None), MessageClass, headers_only)
+        i = 0
+        while i < len(data):
+            j = i + next(sizes)
+            parser.feed(data[i:j])
+            i = j
+        parser.finish()
+        return parser
+
+    class StreamParserTest(unittest.TestCase):
+        def test_messages_complete_as_data_arrives(self):
+            first, second = REQUESTS[1], REQUESTS[2]
+            parser = StreamParser(FakeStream(None), Request)
+            parser.feed(first[:-1])
+            self.assertEqual(parser.messages, [])
+            parser.feed(first[-1] + second[:10])
+            self.assertEqual(len(parser.messages), 1)
+            self.assertEqual(parser.messages[0].msg.body, 'hello')
+            # only the message being received is buffered
+            self.assertEqual(''.join(parser.pieces), second[:10])
+            parser.feed(second[10:])
+            self.assertEqual(len(parser.messages), 2)
+            self.assertEqual(parser.pieces, [])
+            parser.finish()
+            self.assertEqual(parser.messages[1].msg.body, 'abcde')
+            self.assertEqual(parser.messages[1].msg.headers['x-t'], '1')
+
+        def test_like_batch(self):
+            rand = random.Random(0)
+            for headers_only in (False, True):
+                for trial in range(500):
+                    MessageClass, pool = rand.choice([(Request, REQUESTS),
+                                                      (Response, RESPONSES)])
+                    data = ''.join(rand.choice(pool)
+                                   for n in range(rand.randrange(1, 5)))
+                    if rand.random() < .3:
+                        data = data[:rand.randrange(len(data))]
+                    sizes = iter(lambda: rand.randrange(1, 12), None)
+                    parser = stream_parse(MessageClass, data, sizes,
+                                          headers_only)
+                    try:
+                        expected = batch_parse(MessageClass, data)
+                    except common.Error:
+                        assert parser.invalid, data
+                        continue
+                    self.assertEqual(
+                        [describe(msg) for msg in parser.messages],
+                        expected, data)
+
+        def test_headers_only(self):
+            sizes = iter(lambda: 3, None)
+            parser = stream_parse(Response, ''.join(RESPONSES[:3]), sizes,
+                                  headers_only=True)
+            self.assertEqual([(msg.msg.body, msg.msg.body_length)
+                              for msg in parser.messages],
+                             [(None, 3), (None, 0), (None, 4)])
+            self.assertEqual(parser.pieces, [])
+
+        def test_invalid(self):
+            sizes = iter(lambda: 4, None)
+            parser = stream_parse(Response, 'garbage\r\n\r\n', sizes)
+            assert parser.invalid and parser.failed
+            self.assertEqual(parser.messages, [])
+
+    unittest.main()
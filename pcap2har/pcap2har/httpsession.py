@@ -10,6 +10,7 @@ import logging
 from pcaputil import ms_from_dpkt_time, ms_from_dpkt_time_diff
 from pagetracker import PageTracker
 import http
+import dpkt_http_replacement as dpkt_http
 import settings
 
 
@@ -131,65 +132,142 @@ class HttpSession(object):
     '''
     Represents all http traffic from within a pcap.
 
+    Can be used in batch, by passing it a finished PacketDispatcher that kept
+    all its flows, or as a streaming stage: hand each tcp.Flow to open_flow
+    when it starts and to parse_flow as soon as it is finished (see
+    tcp.FlowBuilder's on_open and on_close), then call build_entries once
+    there are no more flows.
+
     Members:
     * user_agents = UserAgentTracker
     * user_agent = most-used user-agent in the flow
     * flows = [http.Flow]
     * entries = [Entry], all http request/response pairs
+    * pairs = [http.MessagePair], parsed but not yet turned into entries
+    * other_flows, other_packets, other_bytes = totals for the flows that
+      were only counted, because they weren't HTTP (see open_flow)
     '''
 
     def __init__(self, packetdispatcher):
         '''
         parses http.flows from packetdispatcher, and parses those for HAR info
         '''
-        # parse http flows
         self.flows = []
-        for flow in packetdispatcher.tcp.flows():
-            try:
-                self.flows.append(http.Flow(flow))
-            except http.Error as error:
-                logging.warning(error)
-            except dpkt.dpkt.Error as error:
-                logging.warning(error)
-        # combine the messages into a list
-        pairs = reduce(lambda p, f: p+f.pairs, self.flows, [])
-        # set-up
+        self.pairs = []
         self.user_agents = UserAgentTracker()
+        self.user_agent = None
         if settings.process_pages:
             self.page_tracker = PageTracker()
         else:
             self.page_tracker = None
         self.entries = []
+        self.dns = packetdispatcher.udp.dns
+        # DNS timing is only added to the first entry for each host name
+        self.names_mentioned = set()
+        self.other_flows = 0
+        self.other_packets = 0
+        self.other_bytes = 0
+        self.add_flows(packetdispatcher.tcp.flows())
+
+    def open_flow(self, tcpflow):
+        '''
+        Sets a new tcp.Flow up to have its HTTP parsed as its data arrives,
+        if settings.stream_http is on. Which direction has the requests is
+        decided once there is data, see http.StreamParser.
+
+        If settings.sniff_protocols is on, flows whose first data isn't HTTP
+        are switched to only counting their packets, see http.sniff.
+        '''
+        if settings.sniff_protocols:
+            tcpflow.sniffer = http.sniff
+        if settings.stream_http:
+            tcpflow.fwd.parser = http.StreamParser(tcpflow.fwd)
+            tcpflow.rev.parser = http.StreamParser(tcpflow.rev)
+
+    def parse_flow(self, tcpflow):
+        '''
+        Parses a finished tcp.Flow for HTTP, and queues its message pairs for
+        build_entries. The TCP data is released afterwards, since the
+        messages have everything that is needed.
+        '''
+        if tcpflow.counting:
+            self.other_flows += 1
+            for direction in (tcpflow.fwd, tcpflow.rev):
+                self.other_packets += direction.packet_count
+                self.other_bytes += direction.byte_count
+            return
+        try:
+            flow = http.Flow(tcpflow)
+        except http.Error as error:
+            logging.warning(error)
+        except dpkt.dpkt.Error as error:
+            logging.warning(error)
+        else:
+            self.flows.append(flow)
+            self.pairs.extend(flow.pairs)
+        if tcpflow.fwd.chunks is not None:
+            tcpflow.fwd.clear_data()
+        if tcpflow.rev.chunks is not None:
+            tcpflow.rev.clear_data()
+
+    def build_entries(self):
+        '''
+        Turns the queued message pairs into entries, in order of connection
+        time. Returns the new entries.
+        '''
+        pairs = self.pairs
+        self.pairs = []
         # sort pairs on request.ts_connect
         pairs.sort(
             key=lambda pair: pair.request.ts_connect
         )
+        entries = []
         # iter through messages and do important stuff
         for msg in pairs:
             entry = Entry(msg.request, msg.response)
             # if msg.request has a user-agent, add it to our list
             if 'user-agent' in msg.request.msg.headers:
-                self.user_agents.add(msg.request.msg.headers['user-agent'])
+                self.user_agents.add(dpkt_http.header_value(
+                    msg.request.msg.headers, 'user-agent'))
             # if msg.request has a referer, keep track of that, too
             if self.page_tracker:
                 entry.pageref = self.page_tracker.getref(entry)
             # add it to the list, if we're supposed to keep it.
             if entry.response or settings.keep_unfulfilled_requests:
-                self.entries.append(entry)
+                entries.append(entry)
+        self.entries.extend(entries)
         self.user_agent = self.user_agents.dominant_user_agent()
         # handle DNS AFTER sorting
         # this algo depends on first appearance of a name
         # being the actual first mention
-        names_mentioned = set()
-        dns = packetdispatcher.udp.dns
-        for entry in self.entries:
+        for entry in entries:
             name = entry.request.host
             # if this is the first time seeing the name
-            if name not in names_mentioned:
-                if name in dns.by_hostname:
+            if name not in self.names_mentioned:
+                if name in self.dns.by_hostname:
                     # TODO: handle multiple DNS queries for now just use last one
-                    entry.add_dns(dns.by_hostname[name][-1])
-                names_mentioned.add(name)
+                    entry.add_dns(self.dns.by_hostname[name][-1])
+                self.names_mentioned.add(name)
+        return entries
+
+    def add_flows(self, tcpflows):
+        '''
+        Parses the finished tcp.Flow's for HTTP, and adds entries for them.
+        Can be called again as more flows finish. Returns the new entries.
+        '''
+        for flow in tcpflows:
+            self.parse_flow(flow)
+        return self.build_entries()
+
+    def take_entries(self):
+        '''
+        Returns the entries gathered so far and forgets about them (and their
+        flows), for when entries are written out as they are found.
+        '''
+        entries = self.entries
+        self.entries = []
+        self.flows = []
+        return entries
 
     def json_repr(self):
         '''
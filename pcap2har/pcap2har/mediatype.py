@@ -1,5 +1,6 @@
 import re
 import logging
+from collections import OrderedDict
 
 
 class MediaType(object):
@@ -11,6 +12,8 @@ class MediaType(object):
     * type: string, the main mime type
     * subtype: string, the mime subtype
     * params: {string: string}. Maybe should be {string: [string]}?
+
+    MediaTypes from lookup() are shared, so don't change them.
     '''
 
     # RE for parsing media types. type and subtype are alpha-numeric strings
@@ -37,8 +40,8 @@ class MediaType(object):
         match = self.mediatype_re.match(data)
         if match:
             # get type/subtype
-            self.type = match.group(1).lower()
-            self.subtype = match.group(2).lower()
+            self.type = intern(match.group(1).lower())
+            self.subtype = intern(match.group(2).lower())
             # params
             self.params = {}
             param_str = match.group(3) # we know this is well-formed, except for extra whitespace
@@ -48,7 +51,7 @@ class MediaType(object):
                     pairmatch = self.nvpair_re.match(pair)
                     if not pairmatch: raise Exception('MediaType.__init__: invalid pair: "' + pair + '"')
                     self.params[pairmatch.group(1)] = pairmatch.group(2)
-            pass
+            self.mime_type = intern('%s/%s' % (self.type, self.subtype))
         else:
             logging.warning('Invalid media type string: "%s"' % data)
             self.set_unknown()
@@ -57,9 +60,17 @@ class MediaType(object):
         self.type = 'application'
         self.subtype = 'x-unknown-content-type'
         self.params = {}
+        self.mime_type = 'application/x-unknown-content-type'
+
+    def is_json(self):
+        '''
+        Returns whether this is a JSON media type, like application/json or
+        application/vnd.api+json.
+        '''
+        return self.subtype == 'json' or self.subtype.endswith('+json')
 
     def mimeType(self):
-        return '%s/%s' % (self.type, self.subtype)
+        return self.mime_type
 
     def __str__(self):
         result = self.mimeType()
@@ -71,6 +82,27 @@ class MediaType(object):
         return 'MediaType(%s)' % self.__str__()
 
 
+# media type string -> MediaType, least recently used first
+cache = OrderedDict()
+CACHE_SIZE = 1024
+
+
+def lookup(data):
+    '''
+    Returns the MediaType for a media type string. The same few strings come
+    up in message after message, so MediaTypes are kept in an LRU cache of
+    CACHE_SIZE entries, and shared.
+    '''
+    try:
+        mediatype = cache.pop(data)
+    except KeyError:
+        mediatype = MediaType(data)
+        if len(cache) >= CACHE_SIZE:
+            cache.popitem(last=False)
+    cache[data] = mediatype
+    return mediatype
+
+
 # test mimetype parsing
 if __name__ == '__main__':
     m = MediaType('application/rdf+xml ;charset=ISO-5591-1   ;foo=bar ')
@@ -1,11 +1,11 @@
-import dpkt
+import decoder
 import tcp
 import udp
 
 
 class PacketDispatcher:
     '''
-    takes a series of dpkt.Packet's and calls callbacks based on their type
+    takes a series of decoded packets and calls callbacks based on their type
 
     For each packet added, picks it apart into its transport-layer packet type
     and adds it to an appropriate handler object. Automatically creates handler
@@ -20,24 +20,20 @@ class PacketDispatcher:
         self.tcp = tcp.FlowBuilder()
         self.udp = udp.Processor()
 
-    def add(self, ts, buf, eth):
+    def add(self, ts, fields):
         '''
         ts = dpkt timestamp
-        buf = original packet data
-        eth = dpkt.ethernet.Ethernet, whether its real Ethernet or from SLL
+        fields = header fields tuple, as returned by decoder.decode
         '''
-        #decide based on pkt.data
-        # if it's IP...
-        if (isinstance(eth.data, dpkt.ip.IP) or
-            isinstance(eth.data, dpkt.ip6.IP6)):
-            ip = eth.data
-            # if it's TCP
-            if isinstance(ip.data, dpkt.tcp.TCP):
-                tcppkt = tcp.Packet(ts, buf, eth, ip, ip.data)
-                self.tcp.add(tcppkt)
-            # if it's UDP...
-            elif isinstance(ip.data, dpkt.udp.UDP):
-                self.udp.add(ts, ip.data)
+        proto, src, dst, sport, dport, seq, ack, flags, data = fields
+        # if it's TCP
+        if proto == decoder.IP_PROTO_TCP:
+            tcppkt = tcp.Packet(ts, ((src, sport), (dst, dport)),
+                                seq, ack, flags, data)
+            self.tcp.add(tcppkt)
+        # if it's UDP...
+        elif proto == decoder.IP_PROTO_UDP:
+            self.udp.add(ts, sport, dport, data)
 
     def finish(self):
         #This is a hack, until tcp.Flow no longer has to be `finish()`ed
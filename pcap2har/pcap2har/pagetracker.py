@@ -1,3 +1,6 @@
+from dpkt_http_replacement import header_value
+
+
 class Page(object):
     '''
     Members:
@@ -21,7 +24,7 @@ class Page(object):
         self.referrers = set()
         self.startedDateTime = entry.startedDateTime
         self.last_entry = entry
-        self.user_agent = entry.request.msg.headers.get('user-agent')
+        self.user_agent = header_value(entry.request.msg.headers, 'user-agent')
         # url, title, etc.
         if is_root_doc:
             self.root_document = entry
@@ -31,7 +34,8 @@ class Page(object):
             # if this is a hanging referrer
             if 'referer' in entry.request.msg.headers:
                 # save it so other entries w/ the same referrer will come here
-                self.referrers.add(entry.request.msg.headers['referer'])
+                self.referrers.add(
+                    header_value(entry.request.msg.headers, 'referer'))
             self.url = None # can't guarantee it's the referrer
             self.title = 'unknown title'
 
@@ -102,8 +106,8 @@ class PageTracker(object):
         '''
         # extract interesting information all at once
         req = entry.request  # all the interesting stuff is in the request
-        referrer = req.msg.headers.get('referer')
-        user_agent = req.msg.headers.get('user-agent')
+        referrer = header_value(req.msg.headers, 'referer')
+        user_agent = header_value(req.msg.headers, 'user-agent')
         matched_page = None  # page we added the request to
         # look through pages for matches
         for page in self.pages:
@@ -141,3 +145,35 @@ class PageTracker(object):
 
     def json_repr(self):
         return sorted(self.pages)
+
+
+if __name__ == '__main__':
+    import unittest
+    from datetime import datetime
+
+    from dpkt_http_replacement import Request
+
+    class FakeRequest(object):
+        def __init__(self, data):
+            self.msg = Request(data)
+            self.url = 'http://example.com' + self.msg.uri
+
+    class FakeEntry(object):
+        def __init__(self, data):
+            self.request = FakeRequest(data)
+            self.response = None
+            self.startedDateTime = datetime(2011, 1, 1)
+
+    class PageTrackerTest(unittest.TestCase):
+        def test_repeated_referer(self):
+            tracker = PageTracker()
+            entry = FakeEntry('GET /a HTTP/1.1\r\nHost: example.com\r\n'
+                              'User-Agent: a\r\nUser-Agent: b\r\n'
+                              'Referer: http://example.com/\r\n'
+                              'Referer: http://example.com/x\r\n\r\n')
+            ref = tracker.getref(entry)
+            # the same referrers, so the same page
+            self.assertEqual(tracker.getref(entry), ref)
+            self.assertEqual(len(tracker.pages), 1)
+
+    unittest.main()
@@ -1,13 +1,16 @@
 import logging
+import time
 
 import dpkt
 
 from pcaputil import *
 import tcp
+import decoder
+import capturefilter
 from packetdispatcher import PacketDispatcher
 
 
-def ParsePcap(dispatcher, filename=None, reader=None):
+def ParsePcap(dispatcher, filename=None, reader=None, accept=None):
     '''
     Parses the passed pcap file or pcap reader.
 
@@ -15,8 +18,10 @@ def ParsePcap(dispatcher, filename=None, reader=None):
 
     Args:
     dispatcher = PacketDispatcher
-    reader = pcaputil.ModifiedReader or None
+    reader = pcaputil.MmapReader or None
     filename = filename of pcap file or None
+    accept = capture filter function, see capturefilter. Defaults to the one
+        configured in settings.
 
     check for filename first; if there is one, load the reader from that. if
     not, look for reader.
@@ -24,7 +29,7 @@ def ParsePcap(dispatcher, filename=None, reader=None):
     if filename:
         f = open(filename, 'rb')
         try:
-            pcap = ModifiedReader(f)
+            pcap = MmapReader(f)
         except dpkt.dpkt.Error as e:
             logging.warning('failed to parse pcap file %s' % filename)
             return
@@ -35,13 +40,13 @@ def ParsePcap(dispatcher, filename=None, reader=None):
     # now we have the reader; read from it
     packet_count = 1  # start from 1 like Wireshark
     errors = [] # store errors for later inspection
+    linktype = pcap.datalink()
+    if accept is None:
+        accept = capturefilter.from_settings()
     try:
-        for packet in pcap:
-            ts = packet[0]   # timestamp
-            buf = packet[1]  # frame data
-            hdr = packet[2]  # libpcap header
+        for ts, buf, caplen, length in pcap:
             # discard incomplete packets
-            if hdr.caplen != hdr.len:
+            if caplen != length:
                 # log packet number so user can diagnose issue in wireshark
                 logging.warning(
                     'ParsePcap: discarding incomplete packet, #%d' %
@@ -49,17 +54,12 @@ def ParsePcap(dispatcher, filename=None, reader=None):
                 continue
             # parse packet
             try:
-                # handle SLL packets, thanks Libo
-                dltoff = dpkt.pcap.dltoff
-                if pcap.dloff == dltoff[dpkt.pcap.DLT_LINUX_SLL]:
-                    eth = dpkt.sll.SLL(buf)
-                # otherwise, for now, assume Ethernet
-                else:
-                    eth = dpkt.ethernet.Ethernet(buf)
-                dispatcher.add(ts, buf, eth)
+                fields = decoder.decode(buf, linktype, accept)
+                if fields:
+                    dispatcher.add(ts, fields)
             # catch errors from this packet
             except dpkt.Error as e:
-                errors.append((packet, e, packet_count))
+                errors.append((ts, e, packet_count))
                 logging.warning(
                     'Error parsing packet: %s. On packet #%d' %
                     (e, packet_count))
@@ -72,11 +72,34 @@ def ParsePcap(dispatcher, filename=None, reader=None):
         errors.append((None, error))
 
 
-def EasyParsePcap(filename=None, reader=None):
+def EasyParsePcap(filename=None, reader=None, accept=None):
     '''
     Like ParsePcap, but makes and returns a PacketDispatcher for you.
     '''
     dispatcher = PacketDispatcher()
-    ParsePcap(dispatcher, filename=filename, reader=reader)
+    ParsePcap(dispatcher, filename=filename, reader=reader, accept=accept)
+    dispatcher.finish()
+    return dispatcher
+
+
+def FollowPcap(dispatcher, filename, idle_timeout=60.0):
+    '''
+    Like ParsePcap, but follows a pcap file that is still being written,
+    until it has not grown for idle_timeout seconds. Set dispatcher.tcp.on_close
+    to get flows as they finish. The dispatcher is finished afterwards.
+    '''
+    flows = dispatcher.tcp
+    def on_idle():
+        # flow timeouts are in capture time, which we assume has moved on
+        # as much as the wall clock since the last data came in
+        if flows.last_ts is not None:
+            flows.expire(flows.last_ts + (time.time() - reader.idle_since))
+    try:
+        reader = FollowReader(open(filename, 'rb'), idle_timeout,
+                              on_idle=on_idle)
+    except dpkt.dpkt.Error:
+        logging.warning('failed to parse pcap file %s' % filename)
+    else:
+        ParsePcap(dispatcher, reader=reader)
     dispatcher.finish()
     return dispatcher
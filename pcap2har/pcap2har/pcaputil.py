@@ -3,8 +3,13 @@ Various small, useful functions which have no other home.
 '''
 
 import dpkt
+import logging
+import mmap
+import os
 import resource
+import struct
 import sys
+import time
 
 # Re-implemented here only because it's missing on AppEngine.
 def inet_ntoa(packed):
@@ -89,14 +94,47 @@ def ms_from_dpkt_time_diff(td1, td2):
     return ms_from_dpkt_time(td1 - td2)
 
 
-class ModifiedReader(object):
+pcap_file_hdr_len = 24
+pcap_pkt_hdr_len = 16
+TCPDUMP_MAGIC = 0xa1b2c3d4
+TCPDUMP_MAGIC_NANO = 0xa1b23c4d  # nanosecond timestamps
+
+
+def _pcap_magic(buf):
     '''
-    A copy of the dpkt pcap Reader. The only change is that the iterator
-    yields the pcap packet header as well, so it's possible to check the true
-    frame length, among other things.
+    Figures out the byte order and timestamp resolution of a pcap file from
+    its header. Returns (struct byte order char, timestamp divisor). Raises
+    ValueError if the magic number is not a pcap one.
+    '''
+    for order in '<>':
+        magic, = struct.unpack(order + 'I', buf[:4])
+        if magic == TCPDUMP_MAGIC:
+            return order, 1000000.0
+        if magic == TCPDUMP_MAGIC_NANO:
+            return order, 1000000000.0
+    raise ValueError, 'invalid tcpdump header'
+
 
-    stolen from pyper.
+class MmapReader(object):
     '''
+    Zero-copy replacement for the dpkt pcap Reader.
+
+    The file is memory-mapped and the record headers are walked with
+    struct.unpack_from, so no header objects or frame copies are made. The
+    iterator yields (ts, buf, caplen, len), where buf is a buffer object
+    pointing into the mapped file. If the file can't be mapped (pipes and
+    other non-regular files), it falls back to reading large blocks and
+    walking those instead.
+
+    Members:
+    * name = filename, or '<unknown>'
+    * snaplen = int, from the file header
+    * linktype = int, DLT_* value from the file header
+    * dloff = int, datalink header offset, as in dpkt.pcap.dltoff
+    '''
+
+    # size of the blocks read when the file can't be mapped
+    block_size = 1 << 20
 
     def __init__(self, fileobj):
         if hasattr(fileobj, 'name'):
@@ -110,23 +148,32 @@ class ModifiedReader(object):
           self.fd = None
 
         self.__f = fileobj
-        buf = self.__f.read(dpkt.pcap.FileHdr.__hdr_len__)
-        self.__fh = dpkt.pcap.FileHdr(buf)
-        self.__ph = dpkt.pcap.PktHdr
-        if self.__fh.magic == dpkt.pcap.PMUDPCT_MAGIC:
-            self.__fh = dpkt.pcap.LEFileHdr(buf)
-            self.__ph = dpkt.pcap.LEPktHdr
-        elif self.__fh.magic != dpkt.pcap.TCPDUMP_MAGIC:
-            raise ValueError, 'invalid tcpdump header'
-        self.snaplen = self.__fh.snaplen
-        self.dloff = dpkt.pcap.dltoff[self.__fh.linktype]
+        self.__map = None
+        if self.fd is not None:
+            try:
+                self.__map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError, EnvironmentError):
+                # not a regular file, or empty. read it the slow way.
+                self.__map = None
+        if self.__map is not None:
+            buf = self.__map[:pcap_file_hdr_len]
+        else:
+            buf = self.__f.read(pcap_file_hdr_len)
+        if len(buf) < pcap_file_hdr_len:
+            raise dpkt.NeedData('pcap file header is too short')
+        self.__order, self.__ts_scale = _pcap_magic(buf)
+        self.__rec_hdr = struct.Struct(self.__order + 'IIII')
+        (magic, v_major, v_minor, thiszone, sigfigs,
+         self.snaplen, self.linktype) = struct.unpack(
+            self.__order + 'IHHiIII', buf)
+        self.dloff = dpkt.pcap.dltoff.get(self.linktype, 0)
         self.filter = ''
 
     def fileno(self):
         return self.fd
 
     def datalink(self):
-        return self.__fh.linktype
+        return self.linktype
 
     def setfilter(self, value, optimize=1):
         return NotImplementedError
@@ -136,24 +183,182 @@ class ModifiedReader(object):
 
     def dispatch(self, cnt, callback, *args):
         if cnt > 0:
+            it = iter(self)
             for i in range(cnt):
-                ts, pkt = self.next()
+                ts, pkt, caplen, length = it.next()
                 callback(ts, pkt, *args)
         else:
-            for ts, pkt in self:
+            for ts, pkt, caplen, length in self:
                 callback(ts, pkt, *args)
 
     def loop(self, callback, *args):
         self.dispatch(0, callback, *args)
 
     def __iter__(self):
-        self.__f.seek(dpkt.pcap.FileHdr.__hdr_len__)
+        if self.__map is not None:
+            return self.__iter_mapped()
+        return self.__iter_buffered()
+
+    def __iter_mapped(self):
+        '''
+        Walks the records of the mapped file. Frames are buffers into the map,
+        which stays alive as long as any of them are referenced.
+        '''
+        mapped = self.__map
+        size = len(mapped)
+        unpack_from = self.__rec_hdr.unpack_from
+        scale = self.__ts_scale
+        offset = pcap_file_hdr_len
+        while offset < size:
+            if offset + pcap_pkt_hdr_len > size:
+                raise dpkt.NeedData('truncated pcap record header')
+            sec, frac, caplen, length = unpack_from(mapped, offset)
+            offset += pcap_pkt_hdr_len
+            yield (sec + frac / scale, buffer(mapped, offset, caplen),
+                   caplen, length)
+            offset += caplen
+
+    def __iter_buffered(self):
+        '''
+        Walks the records of a file that can't be mapped, reading it in large
+        blocks. Frames are buffers into the current block.
+        '''
+        f = self.__f
+        unpack_from = self.__rec_hdr.unpack_from
+        scale = self.__ts_scale
+        block = ''
+        offset = 0
+        while 1:
+            if len(block) - offset < pcap_pkt_hdr_len:
+                block = block[offset:] + f.read(self.block_size)
+                offset = 0
+                if not block:
+                    break
+                if len(block) < pcap_pkt_hdr_len:
+                    raise dpkt.NeedData('truncated pcap record header')
+            sec, frac, caplen, length = unpack_from(block, offset)
+            end = offset + pcap_pkt_hdr_len + caplen
+            if end > len(block):
+                # record straddles the block boundary; pull in the rest
+                block = block[offset:] + f.read(
+                    max(self.block_size, end - len(block)))
+                end -= offset
+                offset = 0
+            start = offset + pcap_pkt_hdr_len
+            yield (sec + frac / scale, buffer(block, start, caplen),
+                   caplen, length)
+            offset = end
+
+
+# the old dpkt-based reader was replaced by MmapReader; keep the name around
+ModifiedReader = MmapReader
+
+class FollowReader(object):
+    '''
+    Reads a pcap file that is still being written, eg. by tcpdump -w.
+
+    Same interface as MmapReader, but when the iterator runs out of complete
+    records it waits for the file to grow instead of stopping, keeping its
+    position in the file. Iteration ends once nothing has been added for
+    idle_timeout seconds.
+
+    Members:
+    * position = int, offset in the file of the next record to be read
+    * on_idle = callable() or None, called every poll_interval seconds while
+      waiting for data
+    * idle_since = wall clock time at which data last came in
+    '''
+
+    # how long to sleep between checks for new data, in seconds
+    poll_interval = 0.5
+
+    def __init__(self, fileobj, idle_timeout=60.0, on_idle=None):
+        if hasattr(fileobj, 'name'):
+          self.name = fileobj.name
+        else:
+          self.name = '<unknown>'
+
+        if hasattr(fileobj, 'fileno'):
+          self.fd = fileobj.fileno()
+        else:
+          self.fd = None
+
+        self.__f = fileobj
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+        self.__block = ''
+        self.position = 0
+        self.idle_since = time.time()
+        if not self.__fill(pcap_file_hdr_len):
+            raise dpkt.NeedData('pcap file header is too short')
+        buf = self.__block[:pcap_file_hdr_len]
+        self.__block = self.__block[pcap_file_hdr_len:]
+        self.position = pcap_file_hdr_len
+        self.__order, self.__ts_scale = _pcap_magic(buf)
+        self.__rec_hdr = struct.Struct(self.__order + 'IIII')
+        (magic, v_major, v_minor, thiszone, sigfigs,
+         self.snaplen, self.linktype) = struct.unpack(
+            self.__order + 'IHHiIII', buf)
+        self.dloff = dpkt.pcap.dltoff.get(self.linktype, 0)
+        self.filter = ''
+
+    def fileno(self):
+        return self.fd
+
+    def datalink(self):
+        return self.linktype
+
+    def __read(self, n):
+        if self.fd is not None:
+            # os.read doesn't get stuck on EOF like buffered files may
+            return os.read(self.fd, n)
+        return self.__f.read(n)
+
+    def __fill(self, n):
+        '''
+        Reads until at least n bytes are buffered, waiting for the file to
+        grow if necessary. Returns False if the file stayed idle for too long.
+        '''
+        while len(self.__block) < n:
+            data = self.__read(max(MmapReader.block_size, n - len(self.__block)))
+            if data:
+                self.__block += data
+                self.idle_since = time.time()
+                continue
+            if time.time() - self.idle_since >= self.idle_timeout:
+                return False
+            if self.on_idle:
+                self.on_idle()
+            time.sleep(self.poll_interval)
+        return True
+
+    def __iter__(self):
+        unpack_from = self.__rec_hdr.unpack_from
+        scale = self.__ts_scale
+        offset = 0
         while 1:
-            buf = self.__f.read(dpkt.pcap.PktHdr.__hdr_len__)
-            if not buf: break
-            hdr = self.__ph(buf)
-            buf = self.__f.read(hdr.caplen)
-            yield (hdr.tv_sec + (hdr.tv_usec / 1000000.0), buf, hdr)
+            if len(self.__block) - offset < pcap_pkt_hdr_len:
+                self.__block = self.__block[offset:]
+                offset = 0
+                if not self.__fill(pcap_pkt_hdr_len):
+                    break
+            sec, frac, caplen, length = unpack_from(self.__block, offset)
+            end = offset + pcap_pkt_hdr_len + caplen
+            if end > len(self.__block):
+                self.__block = self.__block[offset:]
+                end -= offset
+                offset = 0
+                if not self.__fill(end):
+                    break
+            start = offset + pcap_pkt_hdr_len
+            self.position += end - offset
+            yield (sec + frac / scale, buffer(self.__block, start, caplen),
+                   caplen, length)
+            offset = end
+        self.__block = self.__block[offset:]
+        if self.__block:
+            logging.warning('%s: gave up on a partial record at offset %d',
+                            self.name, self.position)
 
 
 class FakeStream(object):
@@ -0,0 +1,279 @@
+'''
+Body retention policy.
+
+Decides, for each HTTP message written into the HAR, how much of its body to
+keep. The policy is a list of rules, each a whitespace-separated list of
+conditions followed by an action. The first rule whose conditions all match
+decides; bodies no rule matches are kept. Conditions:
+
+    mime=GLOB     mime type, eg. image/* or application/*+json
+    status=GLOB   response status, eg. 404 or 5??. Never matches requests.
+    host=GLOB     host of the request, eg. *.example.com
+    size>N        length of the body as sent, N in bytes, or with a k or m
+    size<N          suffix
+    binary        bodies that would be base64 encoded, see
+                  http.Response.is_text
+
+Actions:
+
+    keep          write the body as usual
+    truncate=N    write at most the first N kilobytes of it
+    hash          write only its size and a SHA-1 of it, as content._sha1
+    size          write only its size
+    drop          write neither, and don't work out the text at all, nor
+                  content.compression. The body is only decompressed, so
+                  that the size is the same as with the other actions.
+
+For example: 'mime=image/* drop', 'binary size', 'size>1m truncate=64'.
+
+Globs are matched case-insensitively, with fnmatch.
+'''
+
+from fnmatch import fnmatchcase
+
+import settings
+
+KEEP = 'keep'
+TRUNCATE = 'truncate'
+HASH = 'hash'
+SIZE = 'size'
+DROP = 'drop'
+
+SIZE_SUFFIXES = {'k': 1024, 'm': 1024 * 1024}
+
+
+class RetentionError(ValueError):
+    '''
+    Raised when a retention rule can't be parsed.
+    '''
+    pass
+
+
+class Rule(object):
+    '''
+    One rule of the policy.
+
+    Members:
+    * conditions = [function(http.Response) -> bool]
+    * action = KEEP, TRUNCATE, HASH, SIZE or DROP
+    * limit = int, bytes to keep, for TRUNCATE. None otherwise.
+    * source = string, the rule as it was written
+    '''
+
+    def __init__(self, source):
+        '''
+        Args:
+        source = string, see module docstring
+        '''
+        self.source = source
+        tokens = source.split()
+        if not tokens:
+            raise RetentionError('empty retention rule')
+        self.action, self.limit = parse_action(tokens[-1])
+        self.conditions = [parse_condition(token) for token in tokens[:-1]]
+
+    def matches(self, message):
+        for condition in self.conditions:
+            if not condition(message):
+                return False
+        return True
+
+    def __repr__(self):
+        return 'Rule(%r)' % self.source
+
+
+def parse_size(s, token):
+    '''
+    Parses a number of bytes, with an optional k or m suffix.
+    '''
+    multiplier = SIZE_SUFFIXES.get(s[-1:].lower())
+    if multiplier:
+        s = s[:-1]
+    else:
+        multiplier = 1
+    try:
+        size = int(s)
+    except ValueError:
+        raise RetentionError('invalid size in "%s"' % token)
+    if size < 0:
+        raise RetentionError('invalid size in "%s"' % token)
+    return size * multiplier
+
+
+def parse_action(token):
+    '''
+    Returns (action, limit) for the last token of a rule.
+    '''
+    name, sep, arg = token.partition('=')
+    if name == TRUNCATE and arg:
+        try:
+            kilobytes = int(arg)
+        except ValueError:
+            raise RetentionError('invalid truncate size "%s"' % arg)
+        if kilobytes < 0:
+            raise RetentionError('invalid truncate size "%s"' % arg)
+        return TRUNCATE, kilobytes * 1024
+    if name in (KEEP, HASH, SIZE, DROP) and not sep:
+        return name, None
+    raise RetentionError('unknown retention action "%s"' % token)
+
+
+def parse_condition(token):
+    '''
+    Returns the test function for a condition token.
+    '''
+    if token == 'binary':
+        return lambda message: not message.is_text
+    if token.startswith('size>'):
+        size = parse_size(token[5:], token)
+        return lambda message: message_size(message) > size
+    if token.startswith('size<'):
+        size = parse_size(token[5:], token)
+        return lambda message: message_size(message) < size
+    name, sep, pattern = token.partition('=')
+    if not sep or not pattern:
+        raise RetentionError('unknown retention condition "%s"' % token)
+    pattern = pattern.lower()
+    if name == 'mime':
+        return lambda message: fnmatchcase(message.mimeType, pattern)
+    if name == 'status':
+        return lambda message: status_matches(message_status(message),
+                                              pattern)
+    if name == 'host':
+        return lambda message: fnmatchcase((message.host or '').lower(),
+                                           pattern)
+    raise RetentionError('unknown retention condition "%s"' % token)
+
+
+def message_size(message):
+    '''
+    Length of the body of an http.Request or http.Response, as sent.
+    '''
+    return message.msg.body_length
+
+
+def message_status(message):
+    '''
+    Status of an http.Response as a string, or None for an http.Request.
+    '''
+    return getattr(message.msg, 'status', None)
+
+
+def status_matches(status, pattern):
+    '''
+    Whether a status from message_status matches a glob. Requests, which have
+    no status, never do.
+    '''
+    return status is not None and fnmatchcase(status, pattern)
+
+
+class Policy(object):
+    '''
+    A list of rules, see module docstring.
+
+    Members:
+    * rules = [Rule]
+    '''
+
+    def __init__(self, sources):
+        '''
+        Args:
+        sources = [string], the rules, in order
+        '''
+        self.rules = [Rule(source) for source in sources]
+
+    def choose(self, message):
+        '''
+        Returns (action, limit) for an http.Request or http.Response.
+        '''
+        for rule in self.rules:
+            if rule.matches(message):
+                return rule.action, rule.limit
+        return KEEP, None
+
+
+# the policy from_settings last built, and the rules it was built from
+policy_cache = (None, None)
+
+
+def from_settings():
+    '''
+    Returns the Policy for settings.body_retention. Rebuilt only when the
+    setting changes.
+    '''
+    global policy_cache
+    sources, policy = policy_cache
+    if sources != settings.body_retention:
+        sources = list(settings.body_retention)
+        policy = Policy(sources)
+        policy_cache = (sources, policy)
+    return policy
+
+
+if __name__ == '__main__':
+    import unittest
+
+    class FakeMsg(object):
+        def __init__(self, body_length, status=None):
+            self.body_length = body_length
+            if status is not None:
+                self.status = status
+
+    class FakeMessage(object):
+        def __init__(self, mimeType='text/html', status=None, host=None,
+                     size=0, is_text=True):
+            self.msg = FakeMsg(size, status)
+            self.mimeType = mimeType
+            self.host = host
+            self.is_text = is_text
+
+    class RetentionTest(unittest.TestCase):
+        def test_actions(self):
+            self.assertEqual(parse_action('keep'), (KEEP, None))
+            self.assertEqual(parse_action('truncate=64'), (TRUNCATE, 65536))
+            self.assertEqual(parse_action('drop'), (DROP, None))
+            for token in ('truncate', 'truncate=x', 'truncate=-1', 'hash=1',
+                          'delete'):
+                self.assertRaises(RetentionError, parse_action, token)
+
+        def test_bad_rules(self):
+            for source in ('', 'mime=', 'size>', 'size>1x keep',
+                           'color=red keep', 'binary'):
+                self.assertRaises(RetentionError, Rule, source)
+
+        def test_mime(self):
+            rule = Rule('mime=IMAGE/* drop')
+            assert rule.matches(FakeMessage('image/png'))
+            assert not rule.matches(FakeMessage('text/html'))
+
+        def test_status(self):
+            rule = Rule('status=5?? size')
+            assert rule.matches(FakeMessage(status='503'))
+            assert not rule.matches(FakeMessage(status='200'))
+            assert not rule.matches(FakeMessage())
+            # requests have no status, so even * leaves them alone
+            assert not Rule('status=* size').matches(FakeMessage())
+
+        def test_host(self):
+            rule = Rule('host=*.example.com hash')
+            assert rule.matches(FakeMessage(host='www.Example.com'))
+            assert not rule.matches(FakeMessage(host='example.org'))
+            assert not rule.matches(FakeMessage())
+
+        def test_size_and_binary(self):
+            rule = Rule('binary size>1k size<1m truncate=1')
+            assert rule.matches(FakeMessage(size=2048, is_text=False))
+            assert not rule.matches(FakeMessage(size=1024, is_text=False))
+            assert not rule.matches(FakeMessage(size=2 ** 20, is_text=False))
+            assert not rule.matches(FakeMessage(size=2048))
+
+        def test_first_rule_decides(self):
+            policy = Policy(['mime=image/* drop', 'size>10 truncate=1',
+                             'mime=image/png keep'])
+            self.assertEqual(policy.choose(FakeMessage('image/png', size=20)),
+                             (DROP, None))
+            self.assertEqual(policy.choose(FakeMessage(size=20)),
+                             (TRUNCATE, 1024))
+            self.assertEqual(policy.choose(FakeMessage(size=5)), (KEEP, None))
+
+    unittest.main()
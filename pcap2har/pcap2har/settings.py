@@ -1,6 +1,26 @@
 process_pages = True
 drop_bodies = False  # bodies of http responses, that is
 
+# Most bytes of decompressed body to keep for an HTTP message. Decompression
+# stops holding on to output past this (only the full size is recorded), so
+# that a huge compressed download can't run us out of memory. None for no
+# limit.
+max_decompressed_body = 16 * 1024 * 1024
+
+# Whether to parse JSON bodies and write the parsed value into the HAR as
+# well, as content._json
+parse_json_bodies = False
+
+# Body retention policy (see retention.py): rules deciding how much of each
+# body to write into the HAR. Bodies no rule matches are kept.
+body_retention = []
+
+# Directory of the content-addressed body store (see blobstore.py), or None
+# to write bodies into the HAR. Only bodies of at least blob_min_size bytes
+# are stored.
+blob_store = None
+blob_min_size = 4096
+
 # Whether HTTP parsing should case whether the content length matches the
 # content-length header.
 strict_http_parse_body = False
@@ -8,6 +28,45 @@ strict_http_parse_body = False
 # Whether to pad missing data in TCP flows with 0 bytes
 pad_missing_tcp_data = False
 
+# Whether tcp.Flow's should hold on to all their packets (as Flow.packets),
+# for debugging. Normally packets are dropped once they've been merged into
+# the flow's data, which is all that's needed to build a HAR.
+keep_tcp_packets = False
+
+# Whether to parse HTTP as TCP data arrives (see http.stream), rather than
+# from whole connections once they're finished. Means the connections' data
+# doesn't have to be kept around. Only used when flows are processed as they
+# close, as main.py does.
+stream_http = True
+
+# Whether to look at the first data of each TCP connection, and only count
+# the packets of connections that aren't HTTP instead of reassembling them
+# (see http.flow.sniff). Port hints take precedence over the data:
+# connections to or from http_ports are always treated as HTTP, and those on
+# non_http_ports never are.
+sniff_protocols = True
+http_ports = []
+non_http_ports = []
+
 # Whether to keep requests with missing responses. Could break consumers
 # that assume every request has a response.
 keep_unfulfilled_requests = False
+
+# Capture filter (see capturefilter.py). Packets must match capture_filter, if
+# set, and must not match any of capture_excludes. Evaluated on raw headers,
+# before packets are built.
+capture_filter = None
+capture_excludes = [
+    'tcp port 5223',  # hpvirtgrp
+    'tcp port 5228',  # hpvroom
+    'tcp port 443',  # https, which we can't read anyway
+]
+
+# TCP flows with no packets for this many seconds (of capture time) are
+# considered done, and are parsed and dropped from memory. None to only close
+# flows on FIN/RST, which is the default for whole capture files, since a
+# slow response can come after any pause. Following a growing capture can't
+# wait for the end, so it uses follow_flow_idle_timeout instead, unless this
+# is set.
+flow_idle_timeout = None
+follow_flow_idle_timeout = 60.0
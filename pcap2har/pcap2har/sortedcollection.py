@@ -149,6 +149,20 @@ class SortedCollection(object):
         self._keys.insert(i, key)
         self._items.insert(i, item)
 
+    def index_le(self, key):
+        '''Find the position of the rightmost item with a key-value less-than
+        or equal to key. Return -1 if no such item exists.
+
+        '''
+        return bisect_right(self._keys, key) - 1
+
+    def update_key(self, index):
+        '''Recompute the key of the item at the passed index, after the item
+        has changed. The change must not move the item past its neighbours.
+
+        '''
+        self._keys[index] = self._key(self._items[index])
+
     def find(self, key):
         '''Find item with a key-value equal to key.
         Raise ValueError if no such item exists.
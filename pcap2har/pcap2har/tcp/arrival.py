@@ -0,0 +1,160 @@
+from array import array
+from bisect import bisect_left
+from itertools import izip
+
+# relative sequence numbers (see Direction.relative_seq) can be negative, and
+# run past 2**32. fall back to doubles (exact up to 2**53) where longs are
+# only 32 bits.
+seq_typecode = 'l' if array('l').itemsize >= 8 else 'd'
+
+
+class ArrivalIndex(object):
+    '''
+    Maps sequence numbers to the times data arrived at them, for
+    tcp.Direction. Stands in for a SortedCollection of (seq, ts) tuples, with
+    the same lookup semantics, but keeps the numbers in flat arrays.
+
+    Data nearly always arrives in order, so inserts are appends. Anything that
+    arrives out of order is put aside and sorted into the arrays in one pass
+    the next time the index is read.
+
+    Members:
+    * seqs = array of sequence numbers, sorted
+    * times = array('d') of timestamps, parallel to seqs
+    * pending = [(seq, -insert order, ts)], out-of-order inserts not yet
+      merged into the arrays
+    '''
+
+    def __init__(self):
+        self.seqs = array(seq_typecode)
+        self.times = array('d')
+        self.pending = []
+        self.inserts = 0
+
+    def insert(self, seq, ts):
+        '''
+        Adds an entry. As with SortedCollection.insert, it goes before any
+        entries with the same seq.
+        '''
+        self.inserts += 1
+        if not self.seqs or seq > self.seqs[-1]:
+            self.seqs.append(seq)
+            self.times.append(ts)
+        else:
+            self.pending.append((seq, -self.inserts, ts))
+
+    def merge_pending(self):
+        '''
+        Sorts the out-of-order inserts into the arrays.
+        '''
+        # later inserts sort first among equal seqs, and pending entries go
+        # before array entries with the same seq, since they were added later
+        self.pending.sort()
+        seqs, times = self.seqs, self.times
+        merged_seqs = array(seq_typecode)
+        merged_times = array('d')
+        i = 0
+        for seq, order, ts in self.pending:
+            j = bisect_left(seqs, seq, i)
+            merged_seqs.extend(seqs[i:j])
+            merged_times.extend(times[i:j])
+            merged_seqs.append(seq)
+            merged_times.append(ts)
+            i = j
+        merged_seqs.extend(seqs[i:])
+        merged_times.extend(times[i:])
+        self.seqs, self.times = merged_seqs, merged_times
+        self.pending = []
+
+    def find_le(self, seq):
+        '''
+        Returns the timestamp of the entry with the largest seq less than or
+        equal to seq, or None. Ties between equal seqs are broken the way
+        SortedCollection.find_le breaks them.
+        '''
+        if self.pending:
+            self.merge_pending()
+        seqs = self.seqs
+        if not seqs:
+            return None
+        i = bisect_left(seqs, seq)
+        if i < len(seqs) and seqs[i] == seq:
+            return self.times[i]
+        if i == 0:
+            return None
+        return self.times[i-1]
+
+    def __len__(self):
+        return len(self.seqs) + len(self.pending)
+
+    def __iter__(self):
+        '''
+        Iterates over (seq, ts), sorted by seq.
+        '''
+        if self.pending:
+            self.merge_pending()
+        return izip(self.seqs, self.times)
+
+
+if __name__ == '__main__':
+    import random
+    import unittest
+    from operator import itemgetter
+
+    from ..sortedcollection import SortedCollection
+
+    class ArrivalIndexTest(unittest.TestCase):
+        def test_in_order(self):
+            index = ArrivalIndex()
+            self.assertEqual(index.find_le(0), None)
+            for seq, ts in [(0, 1.0), (100, 2.0), (250, 3.0)]:
+                index.insert(seq, ts)
+            assert not index.pending
+            self.assertEqual(index.find_le(-1), None)
+            self.assertEqual(index.find_le(0), 1.0)
+            self.assertEqual(index.find_le(99), 1.0)
+            self.assertEqual(index.find_le(100), 2.0)
+            self.assertEqual(index.find_le(10 ** 6), 3.0)
+            self.assertEqual(len(index), 3)
+
+        def test_out_of_order(self):
+            index = ArrivalIndex()
+            for seq, ts in [(100, 1.0), (300, 2.0), (200, 3.0), (0, 4.0),
+                            (-50, 5.0)]:
+                index.insert(seq, ts)
+            self.assertEqual(len(index), 5)
+            self.assertEqual(list(index), [(-50, 5.0), (0, 4.0), (100, 1.0),
+                                           (200, 3.0), (300, 2.0)])
+            self.assertEqual(index.find_le(250), 3.0)
+            assert not index.pending
+
+        def test_equal_seqs(self):
+            # ties break as in SortedCollection: the latest insert for an
+            # exact match, the earliest otherwise
+            index = ArrivalIndex()
+            index.insert(100, 1.0)
+            index.insert(100, 2.0)
+            index.insert(0, 3.0)
+            index.insert(100, 4.0)
+            self.assertEqual(index.find_le(100), 4.0)
+            self.assertEqual(index.find_le(150), 1.0)
+
+        def test_like_sorted_collection(self):
+            rand = random.Random(0)
+            for trial in range(200):
+                index = ArrivalIndex()
+                reference = SortedCollection(key=itemgetter(0))
+                for n in range(rand.randrange(1, 30)):
+                    seq = rand.randrange(-20, 200, 10)
+                    ts = float(n)
+                    index.insert(seq, ts)
+                    reference.insert((seq, ts))
+                    probe = rand.randrange(-30, 210)
+                    try:
+                        expected = reference.find_le(probe)[1]
+                    except ValueError:
+                        expected = None
+                    self.assertEqual(index.find_le(probe), expected)
+                self.assertEqual(list(index), list(reference))
+
+    unittest.main()
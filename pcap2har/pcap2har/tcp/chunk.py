@@ -1,28 +1,64 @@
-import seq
-
-
 class Chunk(object):
     '''
     A chunk of data from a TCP stream in the process of being merged. Takes the
     place of the data tuples, ((begin, end), data, logger) in the old algorithm.
     Adds member functions that encapsulate the main merging logic.
+
+    Data is kept as a list of segments, in stream order, and only joined into
+    one string when self.data is read, so that merging a packet doesn't copy
+    everything that arrived before it.
+
+    Members:
+    * segments = [string], the chunk's data, in order, none of them empty.
+      Only the data since the last discard_data, if that was called.
+    * seq_start, seq_end = relative sequence numbers of the data (see
+      tcp.Direction.relative_seq), slice-style
     '''
 
     def __init__(self):
         '''
         Basic initialization on the chunk.
         '''
-        self.data = ''
+        self.segments = []
         self.seq_start = None
         self.seq_end = None
 
+    @property
+    def data(self):
+        '''
+        The chunk's data as one string. The join is remembered, so reading
+        this again costs nothing until more data is merged.
+        '''
+        segments = self.segments
+        if len(segments) > 1:
+            segments[:] = [''.join(segments)]
+        if segments:
+            return segments[0]
+        return ''
+
+    def discard_data(self):
+        '''
+        Lets go of the data merged so far, for when it has been handed on
+        elsewhere. seq_start and seq_end stay as they are, and merging goes on
+        as before; self.data is only what is merged from now on.
+        '''
+        self.segments = []
+
     def merge(self, new, new_seq_callback=None):
         '''
-        Attempts to merge the packet or chunk with the existing data. Returns
+        Attempts to merge another chunk (or anything else with seq_start and
+        data) with the existing data. See merge_data.
+        '''
+        return self.merge_data(new.seq_start, new.data, new_seq_callback)
+
+    def merge_data(self, seq_start, data, new_seq_callback=None):
+        '''
+        Attempts to merge the data with the existing data. Returns
         details of the operation's success or failure.
 
         Args:
-        new = TCPPacket or TCPChunk
+        seq_start = relative sequence number of the start of data
+        data = string
         new_seq_callback = callable(int) or None
 
         new_seq_callback is a function that will be called with sequence numbers
@@ -40,18 +76,19 @@ class Chunk(object):
         the new data was completely inside the existing data
         '''
         # if we have actual data yet (maybe false if there was no init packet)
-        if new.data:
+        if data:
+            seq_end = seq_start + len(data)
             # assume self.seq_* are also valid
-            if self.data:
-                return self.inner_merge((new.seq_start, new.seq_end),
-                                        new.data, new_seq_callback)
+            if self.seq_start is not None:
+                return self.inner_merge((seq_start, seq_end),
+                                        data, new_seq_callback)
             else:
                 # if they have data and we don't, just steal theirs
-                self.data = new.data
-                self.seq_start = new.seq_start
-                self.seq_end = new.seq_end
+                self.segments = [data]
+                self.seq_start = seq_start
+                self.seq_end = seq_end
                 if new_seq_callback:
-                    new_seq_callback(new.seq_start)
+                    new_seq_callback(seq_start)
                 return (True, (True, True))
         # else, there is no data anywhere
         return (False, (False, False))
@@ -59,48 +96,47 @@ class Chunk(object):
     def inner_merge(self, newseq, newdata, callback):
         '''
         Internal implementation function for merging, very similar in interface
-        to merge_pkt, but concentrates on the nitty-gritty logic of merging, as
-        opposed to the high-level logic of merge().
+        to merge_data, but concentrates on the nitty-gritty logic of merging, as
+        opposed to the high-level logic of merge_data().
 
         Args:
         newseq = (seq_begin, seq_end)
         newdata = string, new data
-        callback = see new_seq_callback in merge_pkt
+        callback = see new_seq_callback in merge_data
 
         Returns:
-        see merge_pkt
+        see merge_data
         '''
         # setup
         overlapped = False
         added_front_data = False
         added_back_data = False
+        new_start, new_end = newseq
         # front data?
-        if (seq.lt(newseq[0], self.seq_start) and
-            seq.lte(self.seq_start, newseq[1])):
-            new_data_length = seq.subtract(self.seq_start, newseq[0])
+        if new_start < self.seq_start <= new_end:
+            new_data_length = self.seq_start - new_start
             # slice out new data, stick it on the front
-            self.data = newdata[:new_data_length] + self.data
-            self.seq_start = newseq[0]
+            self.segments.insert(0, newdata[:new_data_length])
+            self.seq_start = new_start
             # notifications
             overlapped = True
             added_front_data = True
             if callback:
-                callback(newseq[0])
+                callback(new_start)
         # back data?
-        if seq.lte(newseq[0], self.seq_end) and seq.lt(self.seq_end, newseq[1]):
-            new_data_length = seq.subtract(newseq[1], self.seq_end)
-            self.data += newdata[-new_data_length:]
+        if new_start <= self.seq_end < new_end:
+            new_data_length = new_end - self.seq_end
+            self.segments.append(newdata[-new_data_length:])
             self.seq_end += new_data_length
             # notifications
             overlapped = True
             added_back_data = True
             if callback:
                 # the first seq number of new data in the back
-                back_seq_start = newseq[1] - new_data_length
+                back_seq_start = new_end - new_data_length
                 callback(back_seq_start)
         # completely inside?
-        if (seq.lte(self.seq_start, newseq[0]) and
-            seq.lte(newseq[1], self.seq_end)):
+        if self.seq_start <= new_start and new_end <= self.seq_end:
             overlapped = True
         # done
         return (overlapped, (added_front_data, added_back_data))
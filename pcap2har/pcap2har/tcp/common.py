@@ -15,7 +15,7 @@ def detect_handshake(packets):
     syn, synack, ack = packets
     fwd_seq = None
     rev_seq = None
-    if syn.tcp.flags & dpkt.tcp.TH_SYN and not syn.tcp.flags & dpkt.tcp.TH_ACK:
+    if syn.flags & dpkt.tcp.TH_SYN and not syn.flags & dpkt.tcp.TH_ACK:
         # have syn
         fwd_seq = syn.seq  # start_seq is the seq field of the segment
         if (synack.flags & dpkt.tcp.TH_SYN and
@@ -1,10 +1,11 @@
-from operator import itemgetter, attrgetter
+from operator import attrgetter
 import logging
 
 from ..sortedcollection import SortedCollection
 
-import packet
 import chunk as tcp
+from arrival import ArrivalIndex
+import seq
 from .. import settings
 
 
@@ -12,17 +13,35 @@ class Direction(object):
     '''
     Represents data moving in one direction in a TCP flow.
 
+    Sequence numbers are taken off the wire once, in add, and turned into
+    offsets from seq_base (see relative_seq). Everything else in the
+    direction, chunks, arrival data and the byte_to_seq numbers that
+    http.Message uses, works in those offsets, which don't wrap around.
+
     Members:
     * finished = bool. Indicates whether more packets should be expected.
     * chunks = [tcp.Chunk] or None, sorted by seq_start. None iff data
       has been cleared.
     * flow = tcp.Flow, the flow to which the direction belongs
-    * arrival_data = SortedCollection([(seq_num, pkt)])
-    * final_arrival_data = SortedCollection([(seq_num, ts)])
+    * arrival_data = ArrivalIndex, seq_num -> ts data first arrived at it
+    * final_arrival_data = ArrivalIndex, seq_num -> ts all data up to it had
+      arrived
     * final_data_chunk = Chunk or None, the chunk that contains the final data,
       only after seq_start is valid and before clear_data
     * final_arrival_pointer = the end sequence number of data that has
       completely arrived
+    * seq_base = the wire sequence number that relative sequence number 0
+      stands for. The first data byte after the handshake. If there was no
+      handshake, the earliest data in the packets tcp.Flow held on to while
+      looking for one, or failing that, the first data to arrive.
+    * seq_high = the highest relative sequence number a packet started at
+    * parser = None, or an object with feed(data) and finish() methods, such
+      as http.StreamParser. If set, data is passed on to it as soon as it's
+      in order, and not kept; self.data is None.
+    * counting = bool, whether the direction only counts packets and bytes,
+      without keeping any data, see count_only
+    * packet_count = number of packets added
+    * byte_count = number of payload bytes added, retransmissions included
     '''
 
     def __init__(self, flow):
@@ -34,11 +53,17 @@ class Direction(object):
         '''
         self.finished = False
         self.flow = flow
-        self.arrival_data = SortedCollection(key=itemgetter(0))
-        self.final_arrival_data = SortedCollection(key=itemgetter(0))
+        self.arrival_data = ArrivalIndex()
+        self.final_arrival_data = ArrivalIndex()
         self.final_arrival_pointer = None
         self.chunks = SortedCollection(key=attrgetter('seq_start'))
         self.final_data_chunk = None
+        self.seq_base = None
+        self.seq_high = 0
+        self.parser = None
+        self.counting = False
+        self.packet_count = 0
+        self.byte_count = 0
 
     def add(self, pkt):
         '''
@@ -52,49 +77,138 @@ class Direction(object):
         '''
         if self.finished:
             raise RuntimeError('tried to add packets to a finished tcp.Direction')
+        self.packet_count += 1
+        self.byte_count += len(pkt.data)
+        if self.counting:
+            return
         if self.chunks is None:
             raise RuntimeError('Tried to add packet to a tcp.Direction'
                                'that has been cleared')
         # discard packets with no payload. we don't care about them here
         if pkt.data == '':
             return
-        # attempt to merge packet with existing chunks
-        merged = False
-        for i, chunk in enumerate(self.chunks):
-            overlapped, (front, back) = chunk.merge(
-                pkt, self.create_merge_callback(pkt))
+        seq_start = self.relative_seq(pkt.seq)
+        if self.flow.sniffer is not None:
+            self.flow.sniff(seq_start, pkt.data)
+            if self.counting:
+                return
+        self.add_data(seq_start, pkt.data, pkt.ts)
+
+    def add_data(self, seq_start, data, ts):
+        '''
+        Merges data into the chunks, see add.
+
+        Args:
+        seq_start = relative sequence number of the data
+        data = string, not empty
+        ts = when the data arrived
+        '''
+        seq_end = seq_start + len(data)
+        stream_start = self.seq_start
+        if (self.parser is not None and stream_start is not None and
+            seq_start < stream_start):
+            # the parser has been fed from stream_start on, and can't take
+            # anything from before it
+            if seq_end <= stream_start:
+                return
+            data = data[stream_start - seq_start:]
+            seq_start = stream_start
+        # attempt to merge data with existing chunks
+        merge_callback = self.create_merge_callback(ts)
+        for i in self.candidate_chunks(seq_start, seq_end):
+            chunk = self.chunks[i]
+            overlapped, (front, back) = chunk.merge_data(
+                seq_start, data, merge_callback)
             if overlapped:
-                # check if this packet bridged the gap between two chunks
-                if back and i < (len(self.chunks)-1):
+                if front:
+                    # seq_start moved down; keep the sort key in step
+                    self.chunks.update_key(i)
+                # check if this packet bridged the gap to the following
+                # chunks. a long retransmission can cover several.
+                while back and i < (len(self.chunks)-1):
                     overlapped2, result2 = chunk.merge(self.chunks[i+1])
                     # if the gap was bridged, the later chunk is obsolete
                     # so get rid of it.
-                    if overlapped2:
-                        self.chunks.remove(i+1)
+                    if not overlapped2:
+                        break
+                    self.chunks.remove(i+1)
                 # if this is the main data chunk, calc final arrival
-                if self.seq_start and chunk.seq_start == self.seq_start:
+                if (stream_start is not None and
+                    chunk.seq_start == stream_start):
                     if front:
                         # packet was first in stream but is just now arriving
-                        self.final_arrival_data.insert((self.seq_start, pkt.ts))
-                    if back:  # usual case
+                        self.final_arrival_data.insert(stream_start, ts)
+                    if back and self.final_arrival_pointer is not None:
+                        # usual case
                         self.final_arrival_data.insert(
-                            (self.final_arrival_pointer, pkt.ts))
+                            self.final_arrival_pointer, ts)
                     if not self.final_data_chunk:
                         self.final_data_chunk = chunk
                     self.final_arrival_pointer = self.final_data_chunk.seq_end
-                merged = True
-                break  # skip further chunks
-        if not merged:
-            # nothing overlapped with the packet
-            # we need a new chunk
-            self.new_chunk(pkt)
+                    if self.parser:
+                        self.feed_parser()
+                return  # skip further chunks
+        # nothing overlapped with the packet
+        # we need a new chunk
+        self.new_chunk(seq_start, data, ts)
+
+    def candidate_chunks(self, seq_start, seq_end):
+        '''
+        Returns the indices of the chunks data from seq_start to seq_end might
+        merge with, in the order they should be tried.
+
+        Usually that's just the last chunk, which the data extends. Otherwise
+        the chunks are binary searched on seq_start. Chunks don't overlap, so
+        only the chunks around seq_start can overlap (or touch) the data,
+        and the first of those is the one to merge with.
+        '''
+        chunks = self.chunks
+        if not chunks:
+            return ()
+        last = len(chunks) - 1
+        if chunks[last].seq_end == seq_start:
+            return (last,)  # in-order data, the common case
+        # the last chunk starting at or before the data, if it reaches the
+        # data. otherwise the first chunk starting after the data.
+        i = chunks.index_le(seq_start)
+        if i < 0 or chunks[i].seq_end < seq_start:
+            i += 1
+        # an earlier chunk might end right where the data starts
+        while i > 0 and chunks[i-1].seq_end >= seq_start:
+            i -= 1
+        # if chunk i doesn't take the data, the data is in the gap after
+        # it, and can only reach the next one
+        return xrange(i, min(i + 2, len(chunks)))
+
+    def relative_seq(self, seq_num):
+        '''
+        Converts a sequence number from the wire to a relative sequence number.
+        The first call decides on seq_base. After that, of all the relative
+        numbers that seq_num could stand for, the one closest to seq_high is
+        picked, so wraparound (and streams over 4GB) come out as plain,
+        increasing integers. Data from before seq_base comes out negative.
+        '''
+        if self.seq_base is None:
+            handshake = self.flow.handshake
+            if handshake:
+                if self is self.flow.fwd:
+                    self.seq_base = handshake[2].seq
+                else:
+                    self.seq_base = (handshake[1].seq + 1) % seq.numberspace
+            else:
+                self.seq_base = seq_num
+        relative = self.seq_high + seq.offset(
+            seq_num, (self.seq_base + self.seq_high) % seq.numberspace)
+        if relative > self.seq_high:
+            self.seq_high = relative
+        return relative
 
     @property
     def data(self):
         '''
         returns the TCP data, as far as it has been determined.
         '''
-        if self.chunks is None:
+        if self.chunks is None or self.parser is not None:
             return None
         if self.final_data_chunk:
             return self.final_data_chunk.data
@@ -104,6 +218,18 @@ class Direction(object):
             else:
                 return None  # just don't know at all
 
+    def count_only(self):
+        '''
+        Stops keeping data. From now on, packets are only counted, and the
+        data that's already there is dropped, along with the parser.
+        '''
+        self.counting = True
+        self.parser = None
+        if self.chunks is not None:
+            self.chunks.clear()
+            self.chunks = None
+        self.final_data_chunk = None
+
     def clear_data(self):
         '''
         Drop data to save memory
@@ -120,14 +246,15 @@ class Direction(object):
     @property
     def seq_start(self):
         '''
-        starting sequence number, as far as we can tell now.
+        starting (relative) sequence number, as far as we can tell now.
         '''
         if self.flow.handshake:
             assert(self in (self.flow.fwd, self.flow.rev))
-            if self is self.flow.fwd:
-                return self.flow.handshake[2].seq
-            else:
-                return self.flow.handshake[1].seq + 1
+            return 0
+        elif self.parser is not None and self.seq_base is not None:
+            # a parser can't wait for finish() to find out where the stream
+            # starts, so without a handshake it starts with the first data
+            return 0
         elif self.finished:
             if self.chunks:
                 return self.chunks[0].seq_start
@@ -152,34 +279,52 @@ class Direction(object):
         # calculate final_arrival
         if not self.final_arrival_data:
             peak_time = 0.0
-            for vertex in self.arrival_data:
-                if vertex[1].ts > peak_time:
-                    peak_time = vertex[1].ts
-                    self.final_arrival_data.insert((vertex[0], vertex[1].ts))
+            for seq_num, ts in self.arrival_data:
+                if ts > peak_time:
+                    peak_time = ts
+                    self.final_arrival_data.insert(seq_num, ts)
 
         if self.chunks and not self.final_data_chunk:
             self.final_data_chunk = self.chunks[0]
+        if self.parser:
+            if self.final_data_chunk:
+                self.feed_parser()
+            self.parser.finish()
+
+    def feed_parser(self):
+        '''
+        Passes the data in final_data_chunk that the parser hasn't seen yet
+        on to it, and drops it.
+        '''
+        chunk = self.final_data_chunk
+        if chunk.segments:
+            data = chunk.data
+            chunk.discard_data()
+            self.parser.feed(data)
 
-    def new_chunk(self, pkt):
+    def new_chunk(self, seq_start, data, ts):
         '''
-        creates a new tcp.Chunk for the pkt to live in. Only called if an
-        attempt has been made to merge the packet with all existing chunks.
+        creates a new tcp.Chunk for the data to live in. Only called if an
+        attempt has been made to merge the data with all existing chunks.
         '''
         chunk = tcp.Chunk()
-        chunk.merge(pkt, self.create_merge_callback(pkt))
-        if self.seq_start and chunk.seq_start == self.seq_start:
+        chunk.merge_data(seq_start, data, self.create_merge_callback(ts))
+        stream_start = self.seq_start
+        if stream_start is not None and chunk.seq_start == stream_start:
             self.final_data_chunk = chunk
             self.final_arrival_pointer = chunk.seq_end
-            self.final_arrival_data.insert((pkt.seq, pkt.ts))
+            self.final_arrival_data.insert(seq_start, ts)
         self.chunks.insert(chunk)
+        if self.parser and chunk is self.final_data_chunk:
+            self.feed_parser()
 
-    def create_merge_callback(self, pkt):
+    def create_merge_callback(self, ts):
         '''
         Returns a function that will serve as a callback for Chunk. It will
-        add the passed sequence number and the packet to self.arrival_data.
+        add the passed sequence number and the timestamp to self.arrival_data.
         '''
         def callback(seq_num):
-            self.arrival_data.insert((seq_num, pkt))
+            self.arrival_data.insert(seq_num, ts)
         return callback
 
     def byte_to_seq(self, byte):
@@ -196,22 +341,16 @@ class Direction(object):
 
     def seq_arrival(self, seq_num):
         '''
-        returns the packet in which the specified sequence number first arrived.
+        returns the time at which the specified sequence number first arrived.
         '''
-        try:
-            return self.arrival_data.find_le(seq_num)[1]
-        except ValueError:
-            return None
+        return self.arrival_data.find_le(seq_num)
 
     def seq_final_arrival(self, seq_num):
         '''
         Returns the time at which the seq number had fully arrived, that is,
         when all the data before it had also arrived.
         '''
-        try:
-            return self.final_arrival_data.find_le(seq_num)[1]
-        except:
-            return None
+        return self.final_arrival_data.find_le(seq_num)
 
     def pad_missing_data(self):
         '''Pad missing data in the flow with zero bytes.'''
@@ -223,8 +362,67 @@ class Direction(object):
             if gap > 0:
                 logging.info('Padding %d missing bytes at %d',
                              gap, prev_chunk.seq_end)
-                first_chunk_pkt = self.seq_arrival(chunk.seq_start)
-                chunk_ts = first_chunk_pkt.ts
-                pad_pkt = packet.PadPacket(prev_chunk.seq_end, gap, chunk_ts)
-                self.add(pad_pkt)
+                chunk_ts = self.seq_arrival(chunk.seq_start)
+                self.add_data(prev_chunk.seq_end, '\0' * gap, chunk_ts)
             prev_chunk = chunk
+
+
+if __name__ == '__main__':
+    import random
+    import unittest
+
+    def make_direction(ranges):
+        direction = Direction(None)
+        for seq_start, seq_end in ranges:
+            chunk = tcp.Chunk()
+            chunk.merge_data(seq_start, 'x' * (seq_end - seq_start))
+            direction.chunks.insert(chunk)
+        return direction
+
+    def takes(chunk, seq_start, seq_end):
+        '''
+        Whether Chunk.merge_data would merge data from seq_start to seq_end
+        into chunk.
+        '''
+        return (seq_start < chunk.seq_start <= seq_end or
+                seq_start <= chunk.seq_end < seq_end or
+                chunk.seq_start <= seq_start and seq_end <= chunk.seq_end)
+
+    class CandidateChunksTest(unittest.TestCase):
+        def test_no_chunks(self):
+            self.assertEqual(make_direction([]).candidate_chunks(0, 10), ())
+
+        def test_in_order(self):
+            direction = make_direction([(0, 10), (20, 30)])
+            self.assertEqual(direction.candidate_chunks(30, 40), (1,))
+
+        def test_gaps(self):
+            direction = make_direction([(0, 10), (20, 30), (40, 50)])
+            self.assertEqual(list(direction.candidate_chunks(-10, -5)),
+                             [0, 1])
+            self.assertEqual(list(direction.candidate_chunks(10, 20)), [0, 1])
+            self.assertEqual(list(direction.candidate_chunks(32, 35)), [2])
+            self.assertEqual(list(direction.candidate_chunks(45, 60)), [2])
+
+        def test_first_taker_is_tried(self):
+            rand = random.Random(0)
+            for trial in range(2000):
+                ranges = []
+                seq = rand.randrange(-20, 20)
+                for n in range(rand.randrange(1, 8)):
+                    length = rand.randrange(1, 10)
+                    ranges.append((seq, seq + length))
+                    seq += length + rand.randrange(1, 10)
+                direction = make_direction(ranges)
+                seq_start = rand.randrange(-30, seq + 10)
+                seq_end = seq_start + rand.randrange(1, 30)
+                chunks = direction.chunks
+                expected = [i for i in range(len(chunks))
+                            if takes(chunks[i], seq_start, seq_end)][:1]
+                tried = [i for i in direction.candidate_chunks(seq_start,
+                                                               seq_end)
+                         if takes(chunks[i], seq_start, seq_end)][:1]
+                self.assertEqual(tried, expected,
+                                 (ranges, seq_start, seq_end))
+
+    unittest.main()
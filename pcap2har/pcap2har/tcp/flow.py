@@ -1,13 +1,21 @@
 import logging
 import common as tcp
 
-from dpkt.tcp import TH_SYN
+from dpkt.tcp import TH_SYN, TH_FIN, TH_RST
 
 from ..sortedcollection import SortedCollection
+from .. import settings
 import seq # hopefully no name collisions
 from direction import Direction
 
 
+# connection states, see Flow.state
+OPENING = 'opening'  # still looking for the handshake
+ESTABLISHED = 'established'
+CLOSING = 'closing'  # one side has sent a FIN
+CLOSED = 'closed'  # both sides sent a FIN, or either sent a RST
+
+
 class NewFlowError(Exception):
     '''
     Used to signal that a new flow should be started.
@@ -24,37 +32,50 @@ class Flow(object):
     * fwd, rev = tcp.Direction, both sides of the communication stream
     * socket = ((srcip, sport), (dstip, dport)). Used for checking the direction
     of packets. Taken from SYN or first packet.
-    * packets = list of tcp.Packet's, all packets in the flow
+    * packets = list of tcp.Packet's, ordered by ts. Only the packets seen
+    while looking for the handshake, unless keep_packets is set, in which case
+    it's all packets in the flow.
+    * keep_packets = bool, whether to hold on to every packet
     * handshake = None or (syn, synack, ack) or False. None while a handshake is
     still being searched for, False when we've given up on finding it.
+    * last_ts = timestamp of the most recent packet
+    * fins = set of (ip, port) endpoints that have sent a FIN
+    * reset = bool, whether a RST has been seen
+    * finished = bool, whether finish() has been called
+    * sniffer = callable(tcp.Flow, data) -> bool, or None. If set, it's
+      called with the first data at the start of either direction (see sniff)
+      and if it returns False, the flow only counts its packets from then on.
     '''
 
-    def __init__(self):
+    def __init__(self, keep_packets=None):
+        '''
+        Args:
+        keep_packets = bool, defaults to settings.keep_tcp_packets. Packets
+        are normally dropped once they have been merged into fwd and rev.
+        '''
+        if keep_packets is None:
+            keep_packets = settings.keep_tcp_packets
+        self.keep_packets = keep_packets
         self.fwd = Direction(self)
         self.rev = Direction(self)
         self.handshake = None
         self.socket = None
         self.packets = []
+        self.last_ts = None
+        self.fins = set()
+        self.reset = False
+        self.finished = False
+        self.sniffer = None
 
     def add(self, pkt):
         '''
         called for every packet coming in, instead of iterating through
         a list
         '''
-        # maintain an invariant that packets are ordered by ts;
-        # perform ordered insertion (as in insertion sort) if they're
-        # not in order because sometimes libpcap writes packets out of
-        # order.
-
-        # the correct position for pkt is found by looping i from
-        # len(self.packets) descending back to 0 (inclusive);
-        # normally, this loop will only run for one iteration.
-        for i in xrange(len(self.packets), -1, -1):
-            # pkt is at the correct position if it is at the
-            # beginning, or if it is >= the packet at its previous
-            # position.
-            if i == 0 or self.packets[i - 1].ts <= pkt.ts: break
-        self.packets.insert(i, pkt)
+        if self.handshake is None or self.keep_packets:
+            self.store_pkt(pkt)
+        if self.last_ts is None or pkt.ts > self.last_ts:
+            self.last_ts = pkt.ts
 
         # look out for handshake
         # add it to the appropriate direction, if we've found or given up on
@@ -77,13 +98,111 @@ class Flow(object):
                 self.handshake = tuple(self.packets[-3:])
                 self.socket = self.handshake[0].socket
                 self.flush_packets()
+        # keep track of connection teardown
+        if pkt.flags & TH_FIN:
+            self.fins.add(pkt.socket[0])
+        if pkt.flags & TH_RST:
+            self.reset = True
+
+    def store_pkt(self, pkt):
+        '''
+        Adds the packet to self.packets, keeping them ordered by ts.
+        '''
+        # maintain an invariant that packets are ordered by ts;
+        # perform ordered insertion (as in insertion sort) if they're
+        # not in order because sometimes libpcap writes packets out of
+        # order.
+
+        # the correct position for pkt is found by looping i from
+        # len(self.packets) descending back to 0 (inclusive);
+        # normally, this loop will only run for one iteration.
+        for i in xrange(len(self.packets), -1, -1):
+            # pkt is at the correct position if it is at the
+            # beginning, or if it is >= the packet at its previous
+            # position.
+            if i == 0 or self.packets[i - 1].ts <= pkt.ts: break
+        self.packets.insert(i, pkt)
+
+    @property
+    def state(self):
+        '''
+        Where the connection is in its lifecycle, one of OPENING, ESTABLISHED,
+        CLOSING and CLOSED. Flows whose handshake was never seen count as
+        ESTABLISHED once we've given up looking for it.
+        '''
+        if self.reset or len(self.fins) == 2:
+            return CLOSED
+        elif self.fins:
+            return CLOSING
+        elif self.handshake is None:
+            return OPENING
+        else:
+            return ESTABLISHED
+
+    @property
+    def closed(self):
+        '''
+        Whether the connection has been torn down, either by a FIN from both
+        sides or by a RST.
+        '''
+        return self.state == CLOSED
+
+    @property
+    def counting(self):
+        '''
+        Whether the flow only counts its packets, see count_only.
+        '''
+        return self.fwd.counting
+
+    def sniff(self, seq_start, data):
+        '''
+        Called by fwd and rev with each packet's data while sniffer is set.
+        Once data turns up at the start of a direction, hands it to sniffer,
+        which isn't asked again. Without a handshake, where the start is
+        only a guess, the first data there is will do.
+
+        Args:
+        seq_start = relative sequence number of the data
+        data = string, not empty
+        '''
+        if self.handshake and seq_start != 0:
+            return  # an early packet got lost or reordered; wait for it
+        sniffer = self.sniffer
+        self.sniffer = None
+        if not sniffer(self, data):
+            self.count_only()
+
+    def count_only(self):
+        '''
+        Drops the flow's data and stops keeping any, eg. because it's a
+        protocol nobody is going to parse. Packets are still counted, see
+        tcp.Direction.packet_count and byte_count.
+        '''
+        self.sniffer = None
+        self.fwd.count_only()
+        self.rev.count_only()
 
     def flush_packets(self):
         '''
         Flush packet buffer by merging all packets into either fwd or rev.
+        Unless keep_packets is set, the buffer is emptied; the handshake
+        packets are still around in self.handshake.
+
+        Without a handshake, each direction's stream starts at the earliest
+        data in the buffer, even if that wasn't the first to arrive (see
+        tcp.Direction.relative_seq).
         '''
+        if not self.handshake:
+            for p in self.packets:
+                if p.data:
+                    direction = self.fwd if self.samedir(p) else self.rev
+                    if (direction.seq_base is None or
+                        seq.lt(p.seq, direction.seq_base)):
+                        direction.seq_base = p.seq
         for p in self.packets:
             self.merge_pkt(p)
+        if not self.keep_packets:
+            self.packets = []
 
     def merge_pkt(self, pkt):
         '''
@@ -108,6 +227,7 @@ class Flow(object):
             self.flush_packets()
         self.fwd.finish()
         self.rev.finish()
+        self.finished = True
 
     def samedir(self, pkt):
         '''
@@ -130,9 +250,16 @@ class Flow(object):
     def writeout_data(self, basename):
         '''
         writes out the data in the flows to two files named basename-fwd.dat and
-        basename-rev.dat.
+        basename-rev.dat. Directions whose data wasn't kept, because a parser
+        took it as it arrived (see tcp.Direction.parser) or it was only
+        counted, are skipped with a warning.
         '''
-        with open(basename + '-fwd.dat', 'wb') as f:
-            f.write(self.fwd.data)
-        with open(basename + '-rev.dat', 'wb') as f:
-            f.write(self.rev.data)
+        for direction, suffix in ((self.fwd, '-fwd.dat'),
+                                  (self.rev, '-rev.dat')):
+            if direction.data is None:
+                logging.warning('not writing out %s%s: the data of the '
+                                'tcp.Direction was not kept', basename,
+                                suffix)
+                continue
+            with open(basename + suffix, 'wb') as f:
+                f.write(direction.data)
@@ -1,5 +1,13 @@
 import flow as tcp
-import logging
+from dpkt.tcp import TH_SYN
+
+from .. import settings
+
+# default for FlowBuilder's idle_timeout, meaning settings.flow_idle_timeout
+DEFAULT_TIMEOUT = object()
+# how long sockets of torn down flows are remembered when flows don't expire,
+# in seconds of capture time. see FlowBuilder.closed.
+CLOSED_MEMORY = 60.0
 
 
 class FlowBuilder(object):
@@ -11,47 +19,85 @@ class FlowBuilder(object):
     .add(pkt) for each packet. This will find the right tcp.Flow in the dict and
     call .add() on it. This class should be renamed.
 
+    If on_close is set, FlowBuilder follows the state of each connection
+    (see tcp.Flow.state), and finishes and forgets flows as soon as they are
+    closed or idle, so only connections that are still live are kept in
+    memory. Without it, all flows are kept until finish().
+
+    on_open, if set, is called with each new flow before any packets are
+    added to it, eg. to attach parsers to its directions.
+
     Members:
-    flowdict = {socket: [tcp.Flow]}
+    flowdict = {socket: [tcp.Flow]}, live flows
+    on_open = callable(tcp.Flow) or None
+    on_close = callable(tcp.Flow) or None
+    idle_timeout = seconds of capture time, or None
+    closed = {socket: ts}, sockets of flows that were torn down, so that stray
+        packets after the teardown don't start a new flow. Forgotten after
+        idle_timeout (or CLOSED_MEMORY) seconds.
     '''
 
-    def __init__(self):
+    def __init__(self, on_close=None, idle_timeout=DEFAULT_TIMEOUT,
+                 on_open=None):
+        '''
+        Args:
+        on_close = callable(tcp.Flow) or None. If set, flows are finished as
+            soon as they are torn down (or idle_timeout passes without any
+            packets for them), handed to on_close and forgotten. Otherwise
+            all flows are kept until finish().
+        idle_timeout = seconds, or None to only close flows on FIN/RST.
+            Defaults to settings.flow_idle_timeout.
+        on_open = callable(tcp.Flow) or None, called with each new flow.
+        '''
+        if idle_timeout is DEFAULT_TIMEOUT:
+            idle_timeout = settings.flow_idle_timeout
         self.flowdict = {}
+        self.on_open = on_open
+        self.on_close = on_close
+        self.idle_timeout = idle_timeout
+        self.closed = {}
+        self.last_ts = None  # most recent packet timestamp
+        self.last_sweep = None
 
     def add(self, pkt):
         '''
-        filters out unhandled packets, and sorts the remainder into the correct
-        flow
+        sorts the packet into the correct flow. Unwanted packets are dropped
+        earlier, by the capture filter (see capturefilter.py).
         '''
         #shortcut vars
         src, dst = pkt.socket
-        srcip, srcport = src
-        dstip, dstport = dst
-        # filter out weird packets, LSONG
-        if srcport == 5223 or dstport == 5223:
-            logging.warning('hpvirtgrp packets are ignored')
-            return
-        if srcport == 5228 or dstport == 5228:
-            logging.warning('hpvroom packets are ignored')
-            return
-        if srcport == 443 or dstport == 443:
-            logging.warning('https packets are ignored')
-            return
+        if self.last_ts is None or pkt.ts > self.last_ts:
+            self.last_ts = pkt.ts
         # sort the packet into a tcp.Flow in flowdict. If NewFlowError is
         # raised, the existing flow doesn't want any more packets, so we
         # should start a new flow.
         if (src, dst) in self.flowdict:
-            try:
-                self.flowdict[(src, dst)][-1].add(pkt)
-            except tcp.NewFlowError:
-                self.new_flow((src, dst), pkt)
+            socket = (src, dst)
         elif (dst, src) in self.flowdict:
+            socket = (dst, src)
+        else:
+            socket = None
+        if socket:
             try:
-                self.flowdict[(dst, src)][-1].add(pkt)
+                self.flowdict[socket][-1].add(pkt)
             except tcp.NewFlowError:
-                self.new_flow((dst, src), pkt)
+                self.new_flow(socket, pkt)
+        elif (self.on_close and not pkt.flags & TH_SYN and
+              ((src, dst) in self.closed or (dst, src) in self.closed)):
+            # leftover ACKs and such from a connection we already closed
+            return
         else:
-            self.new_flow((src, dst), pkt)
+            socket = (src, dst)
+            self.new_flow(socket, pkt)
+        if self.on_close:
+            flow = self.flowdict[socket][-1]
+            if flow.closed:
+                self.close_flow(socket, flow)
+            if self.last_sweep is None:
+                self.last_sweep = pkt.ts
+            elif pkt.ts - self.last_sweep >= 1.0:
+                self.expire(pkt.ts)
+                self.last_sweep = pkt.ts
 
     def new_flow(self, socket, packet):
         '''
@@ -64,13 +110,50 @@ class FlowBuilder(object):
         * socket: ((ip, port), (ip, port))
         * packet: tcp.Packet
         '''
+        if self.on_close and socket in self.flowdict:
+            # a new connection on the same socket ends the old one
+            self.close_flow(socket, self.flowdict[socket][-1])
         newflow = tcp.Flow()
+        if self.on_open:
+            self.on_open(newflow)
         newflow.add(packet)
         if socket in self.flowdict:
             self.flowdict[socket].append(newflow)
         else:
             self.flowdict[socket] = [newflow]
 
+    def close_flow(self, socket, flow):
+        '''
+        Finishes the flow, removes it from flowdict and passes it to on_close.
+        '''
+        flowlist = self.flowdict[socket]
+        flowlist.remove(flow)
+        if not flowlist:
+            del self.flowdict[socket]
+        if flow.closed:
+            # only torn down connections leave stragglers behind. idle ones
+            # may well pick up again, as a new flow.
+            self.closed[socket] = flow.last_ts
+        flow.finish()
+        self.on_close(flow)
+
+    def expire(self, now):
+        '''
+        Closes flows that have had no packets for idle_timeout seconds, as of
+        now, and forgets about sockets that were closed that long ago (or
+        CLOSED_MEMORY seconds ago, if flows don't expire).
+        '''
+        if self.idle_timeout is None:
+            cutoff = now - CLOSED_MEMORY
+        else:
+            cutoff = now - self.idle_timeout
+            for socket, flowlist in self.flowdict.items():
+                if flowlist[-1].last_ts < cutoff:
+                    self.close_flow(socket, flowlist[-1])
+        for socket, ts in self.closed.items():
+            if ts < cutoff:
+                del self.closed[socket]
+
     def flows(self):
         '''
         Generator that iterates over all flows.
@@ -80,4 +163,9 @@ class FlowBuilder(object):
                 yield flow
 
     def finish(self):
-        map(tcp.Flow.finish, self.flows())
+        if self.on_close:
+            for socket, flowlist in self.flowdict.items():
+                for flow in list(flowlist):
+                    self.close_flow(socket, flow)
+        else:
+            map(tcp.Flow.finish, self.flows())
@@ -46,6 +46,14 @@ def lte(a, b):
 def gte(a, b):
     return subtract(a, b) >= 0
 
+def offset(a, b):
+    '''
+    Returns how far sequence number a is ahead of b (negative if it's
+    behind), taking the shorter way around the number space. The result is in
+    [-halfspace, halfspace).
+    '''
+    return (a - b + halfspace) % numberspace - halfspace
+
 
 import unittest
 
@@ -64,6 +72,15 @@ class TestTcpSeqSubtraction(unittest.TestCase):
         self.assertEqual(subtract(0xd0000000, 0x10000000), -0x40000000)
 
 
+class TestOffset(unittest.TestCase):
+    def testOffset(self):
+        self.assertEqual(offset(500, 1), 499)
+        self.assertEqual(offset(1, 500), -499)
+        self.assertEqual(offset(1, 0xffffffff), 2)
+        self.assertEqual(offset(0xffffffff, 1), -2)
+        self.assertEqual(offset(0x10000000, 0xd0000000), 0x40000000)
+
+
 class TestLessThan(unittest.TestCase):
     def testLessThan(self):
         self.assertTrue( not lt(100, 10))
@@ -74,6 +91,7 @@ def runtests():
     suite = unittest.TestSuite()
     suite.addTest(TestTcpSeqSubtraction('testNormalSubtraction'))
     suite.addTest(TestTcpSeqSubtraction('testWrappedSubtraction'))
+    suite.addTest(TestOffset('testOffset'))
     suite.addTest(TestLessThan('testLessThan'))
     runner = unittest.TextTestRunner()
     runner.run(suite)
@@ -7,9 +7,9 @@ class Processor(object):
     '''
     Processes and interprets UDP packets.
 
-    Call its add(pkt) method with each dpkt.udp.UDP packet from the pcap or
-    whatever. It will expose information from the packets, at this point mostly
-    DNS information. It will automatically create a dns processor and expose it
+    Call its add(ts, sport, dport, data) method with each UDP packet from the
+    pcap or whatever. It will expose information from the packets, at this
+    point mostly DNS information. It will automatically create a dns processor and expose it
     as its `dns` member variable.
 
     This class is basically a nonce, if I may borrow the term, for the sake of
@@ -20,16 +20,17 @@ class Processor(object):
     def __init__(self):
         self.dns = dns.Processor()
 
-    def add(self, ts, pkt):
+    def add(self, ts, sport, dport, data):
         '''
-        pkt = dpkt.udp.UDP
+        sport, dport = int, UDP ports
+        data = string, UDP payload
         '''
         #check for DNS
-        if pkt.sport == 53 or pkt.dport == 53:
+        if sport == 53 or dport == 53:
             try:
-                dnspkt = dpkt.dns.DNS(pkt.data)
+                dnspkt = dpkt.dns.DNS(data)
                 self.dns.add(dns.Packet(ts, dnspkt))
             except dpkt.Error:
                 logging.warning('UDP packet on port 53 was not DNS')
         else:
-            logging.warning('unkown UDP ports: %d->%d' % (pkt.sport, pkt.dport))
+            logging.warning('unkown UDP ports: %d->%d' % (sport, dport))